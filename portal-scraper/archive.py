@@ -0,0 +1,210 @@
+'''Archive of the raw data a scrape fetches (the API's response, portal
+result pages, and the terms and course areas read off the portal's search
+form), so a run can be recorded once and then replayed from disk as often
+as needed, without a browser, the portal or API credentials. Replaying
+the same snapshot before and after a change to the parsing or merging
+code, into two directories, shows exactly what the change does to the
+output.
+
+An archive is a directory holding:
+
+  objects.pack     zlib-compressed fetched bytes, one after another
+  objects.idx      {sha256 of the bytes: [offset, compressed length]}
+  loose/           objects recorded but not yet added to the pack
+  snapshots/       <name>.json for each recorded run: {"created": Unix
+                   seconds, "fetches": {key: sha256}}
+
+Objects are named by their content, so a page that hasn't changed since
+the last recording (a past term's, say) is stored once however many
+snapshots have it. While a run is recorded, each process (pool workers
+included) writes its objects under loose/ and appends a line per fetch to
+snapshots/<name>.log; finish() then packs the objects and writes the
+snapshot. Only one run should be recorded into an archive at a time.
+
+Replay reads the pack through a memory map, so each process only reads
+(and the OS only caches once) the pages it parses.'''
+
+import argparse
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import time
+import zlib
+
+import cache
+
+PACK_NAME = 'objects.pack'
+INDEX_NAME = 'objects.idx'
+LOOSE_DIR = 'loose'
+SNAPSHOTS_DIR = 'snapshots'
+COMPRESS_LEVEL = 9
+API_KEY = 'api'
+PORTAL_INFO_KEY = 'portal_info'
+
+def portal_key(term=None, coursearea=None):
+    '''The key of a portal search's results page.'''
+    return '/'.join(['portal', term or ''] + ([coursearea] if coursearea is not None else []))
+
+def snapshot_name(seconds=None):
+    '''A new snapshot's default name, its UTC time.'''
+    return datetime.datetime.fromtimestamp(time.time() if seconds is None else seconds,
+                                           datetime.timezone.utc).strftime('%Y-%m-%dT%H%M%SZ')
+
+class FetchArchive:
+    '''Records fetches into, or replays them from, one snapshot of the
+    archive in directory; an archive with no directory does nothing.'''
+    def __init__(self, directory=None, snapshot=None, mode=None):
+        self.open(directory, snapshot, mode)
+
+    def open(self, directory=None, snapshot=None, mode=None):
+        '''mode is 'record' or 'replay'; replay defaults to the snapshot
+        recorded last.'''
+        self.directory = directory
+        self.mode = mode
+        self.snapshot = snapshot
+        self.fetches = None
+        self.pack = None
+        self.index = None
+        if directory is not None and mode == 'replay' and snapshot is None:
+            self.snapshot = self.latest_snapshot()
+
+    @property
+    def recording(self):
+        return self.directory is not None and self.mode == 'record'
+
+    @property
+    def replaying(self):
+        return self.directory is not None and self.mode == 'replay'
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def snapshots(self):
+        '''{name: snapshot} of every finished snapshot.'''
+        snapshots = {}
+        try:
+            names = os.listdir(self.path(SNAPSHOTS_DIR))
+        except FileNotFoundError:
+            return snapshots
+        for name in names:
+            if name.endswith('.json'):
+                with open(self.path(SNAPSHOTS_DIR, name)) as f:
+                    snapshots[name[:-len('.json')]] = json.load(f)
+        return snapshots
+
+    def latest_snapshot(self):
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise FileNotFoundError('no snapshots in {}'.format(self.directory))
+        return max(snapshots, key=lambda name: (snapshots[name]['created'], name))
+
+    def record(self, key, data):
+        '''Stores data (bytes) as what was fetched for key, if recording.'''
+        if not self.recording:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(LOOSE_DIR, digest + '.z')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cache.atomic_write(path, zlib.compress(data, COMPRESS_LEVEL))
+        os.makedirs(self.path(SNAPSHOTS_DIR), exist_ok=True)
+        # a single short O_APPEND write, so lines from different processes
+        # don't interleave
+        line = (json.dumps([key, digest]) + '\n').encode('utf-8')
+        fd = os.open(self.path(SNAPSHOTS_DIR, self.snapshot + '.log'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read_index(self):
+        try:
+            with open(self.path(INDEX_NAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def finish(self):
+        '''Packs what this recording stored and writes its snapshot;
+        returns the number of fetches in it.'''
+        if not self.recording:
+            return 0
+        log_path = self.path(SNAPSHOTS_DIR, self.snapshot + '.log')
+        fetches = {}
+        try:
+            with open(log_path) as f:
+                for line in f:
+                    key, digest = json.loads(line)
+                    fetches[key] = digest
+        except FileNotFoundError:
+            pass
+        index = self.read_index()
+        loose = self.path(LOOSE_DIR)
+        names = sorted(os.listdir(loose)) if os.path.isdir(loose) else []
+        with open(self.path(PACK_NAME), 'ab') as pack:
+            # anything an earlier, interrupted append left past the
+            # indexed objects is overwritten
+            end = max((offset + length for offset, length in index.values()), default=0)
+            pack.truncate(end)
+            for name in names:
+                digest = name[:-len('.z')]
+                with open(os.path.join(loose, name), 'rb') as f:
+                    compressed = f.read()
+                if digest not in index:
+                    pack.write(compressed)
+                    index[digest] = [end, len(compressed)]
+                    end += len(compressed)
+            pack.flush()
+            os.fsync(pack.fileno())
+        cache.atomic_write(self.path(INDEX_NAME), json.dumps(index, sort_keys=True).encode('utf-8'))
+        cache.atomic_write(self.path(SNAPSHOTS_DIR, self.snapshot + '.json'),
+                           json.dumps({'created': int(time.time()), 'fetches': fetches},
+                                      indent=1, sort_keys=True).encode('utf-8'))
+        for name in names:
+            os.unlink(os.path.join(loose, name))
+        if os.path.exists(log_path):
+            os.unlink(log_path)
+        return len(fetches)
+
+    def has(self, key):
+        '''Whether the snapshot being replayed has a fetch for key.'''
+        if self.fetches is None:
+            with open(self.path(SNAPSHOTS_DIR, self.snapshot + '.json')) as f:
+                self.fetches = json.load(f)['fetches']
+            self.index = self.read_index()
+        return key in self.fetches
+
+    def get(self, key):
+        '''The bytes fetched for key in the snapshot being replayed.'''
+        if not self.has(key):
+            raise KeyError('{!r} was not fetched in snapshot {}'.format(key, self.snapshot))
+        if self.pack is None:
+            with open(self.path(PACK_NAME), 'rb') as f:
+                self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = self.index[self.fetches[key]]
+        return zlib.decompress(self.pack[offset:offset + length])
+
+    def close(self):
+        if self.pack is not None:
+            self.pack.close()
+            self.pack = None
+
+def main():
+    parser = argparse.ArgumentParser(description='list the snapshots scrape.py --record made')
+    parser.add_argument('directory', help='the --record directory')
+    parser.add_argument('snapshot', nargs='?', help='list the fetches of this snapshot')
+    args = parser.parse_args()
+    archive = FetchArchive(args.directory)
+    snapshots = archive.snapshots()
+    if args.snapshot is None:
+        for name in sorted(snapshots, key=lambda name: snapshots[name]['created']):
+            print('{}\t{} fetches'.format(name, len(snapshots[name]['fetches'])))
+        return
+    index = archive.read_index()
+    for key, digest in sorted(snapshots[args.snapshot]['fetches'].items()):
+        print('{}\t{}\t{} bytes compressed'.format(key, digest[:12], index[digest][1]))
+
+if __name__ == '__main__':
+    main()
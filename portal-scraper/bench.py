@@ -0,0 +1,858 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import collections
+import contextlib
+import copy
+import datetime
+import gzip
+import hashlib
+import html
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import delta
+import fetching
+import scrape
+
+DEPTS = ['CSCI', 'MATH', 'PHYS', 'ENGL', 'HIST', 'CHEM', 'BIOL', 'ECON', 'MUS ', 'PE  ']
+CAMPUSES = ['HM', 'PO', 'PZ', 'CM', 'SC', 'KS', 'JM', 'JP', 'CG', 'AF']
+
+def synthetic_course_id(i):
+    # unique for the first 100k courses
+    return '{}{:03d}  {}'.format(DEPTS[i // 1000 % len(DEPTS)], i % 1000,
+                                CAMPUSES[i // (1000 * len(DEPTS)) % len(CAMPUSES)])
+
+# schedule times the API really sends now and then
+ODD_API_TIMES = ['0', '900', '0900', '12', '1200', '2359']
+
+def synthetic_api_course(rng, i, messy=False):
+    course_id = synthetic_course_id(i)
+    sections = []
+    for section in range(1, rng.randint(1, 4) + 1):
+        for term in ['FA2024', 'SP2025']:
+            sections.append({
+                'externalId': '{}-{:02d} {}'.format(course_id, section, term),
+                'capacity': 30,
+                'currentEnrollment': rng.randint(0, 30),
+                'sectionInstructor': [{'firstName': 'Ada', 'lastName': 'Lovelace{}'.format(rng.randint(0, 200))}],
+                'calendarSessions': [{'externalId': term, 'beginDate': '2024-09-01', 'endDate': '2024-12-15'}],
+                'courseSectionSchedule': [{
+                    'ClassMeetingDays': rng.choice(['M-W-F--', '-T-R---']),
+                    'ClassBeginningTime': rng.choice(['900', '1015', '1315']),
+                    'ClassEndingTime': rng.choice(['950', '1130', '1430']),
+                    'InstructionSiteName': 'Shanahan Center 1460 ',
+                }],
+            })
+            if messy:
+                mess_up_api_section(rng, sections)
+    return {
+        'courseNumber': course_id,
+        'externalId': course_id,
+        'courseTitle': 'Synthetic Course {}'.format(i),
+        'description': 'lorem ipsum ' * rng.randint(5, 50),
+        'courseSections': sections,
+    }
+
+def mess_up_api_section(rng, sections):
+    '''Gives the last of sections one of the problems real API data has,
+    now and then.'''
+    section = sections[-1]
+    roll = rng.random()
+    if roll < 0.03:
+        sections.append(copy.deepcopy(section))
+    elif roll < 0.06:
+        # a schedule list that won't line up with the portal's
+        section['courseSectionSchedule'].append({
+            'ClassMeetingDays': rng.choice(['-------', '----F--', 'M------']),
+            'ClassBeginningTime': rng.choice(ODD_API_TIMES),
+            'ClassEndingTime': rng.choice(ODD_API_TIMES),
+            'InstructionSiteName': ' ',
+        })
+    elif roll < 0.08:
+        part = section['courseSectionSchedule'][0]
+        part['ClassBeginningTime'] = rng.choice(ODD_API_TIMES)
+        part['ClassEndingTime'] = rng.choice(ODD_API_TIMES)
+    elif roll < 0.09:
+        del section[rng.choice(['courseSectionSchedule', 'calendarSessions', 'sectionInstructor'])]
+
+def write_api_payload(f, courses, seed=0, messy=False):
+    rng = random.Random(seed)
+    json.dump({'data': [synthetic_api_course(rng, i, messy) for i in range(courses)]}, f)
+
+def file_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(scrape.API_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def bench_api_memory(args):
+    '''Compares peak memory of formatting the API payload after loading it
+    whole against formatting it while it streams in.'''
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        write_api_payload(f, args.courses)
+    try:
+        size = os.path.getsize(f.name)
+        def buffered():
+            api_data = json.loads(b''.join(file_chunks(f.name)))['data']
+            return scrape.format_api_data_as_portal_data(api_data)
+        def streaming():
+            return scrape.format_api_data_as_portal_data(scrape.iter_json_array_items(file_chunks(f.name), 'data'))
+        print('payload: {} courses, {:.1f} MB'.format(args.courses, size / 1e6))
+        results = []
+        for name, func in [('buffered', buffered), ('streaming', streaming)]:
+            result, elapsed, peak = measure(func)
+            results.append(result)
+            print('{:>10}: {:.2f}s, peak {:.1f} MB'.format(name, elapsed, peak / 1e6))
+        if results[0] != results[1]:
+            print('error: buffered and streaming output differ', file=sys.stderr)
+            return 1
+    finally:
+        os.unlink(f.name)
+    return 0
+
+PORTAL_ROW = ('<tr class="{row_class}"><td><input type="checkbox" /></td>'
+              '<td><a href="#">{section_id}</a></td><td>{name}</td>'
+              '<td><ul>{instructors}</ul></td><td>{enrolled}/{capacity}</td><td>{status}</td>'
+              '<td><ul>{schedule}</ul></td><td>{credits:.2f}</td><td>9/3/2024</td><td>12/13/2024</td></tr>\n')
+PORTAL_SUB_ROW = '<tr class="subItem"><td colspan="10"><table><tr><td>Fee: $50.00</td></tr></table></td></tr>\n'
+
+def synthetic_schedule_string(rng):
+    start = rng.choice([8, 9, 10, 11, 13, 14, 15])
+    return '{}\u00a0{}:{:02d} - {}:{:02d} {}M; HM Campus, {}, {}'.format(
+        rng.choice(['MW', 'TR', 'MWF', 'F']), (start - 1) % 12 + 1, rng.choice([0, 15, 30]),
+        start % 12 + 1, 15, 'P' if start + 1 >= 12 else 'A',
+        rng.choice(['Shanahan Center', 'Parsons', 'Keck']), rng.randint(100, 2500))
+
+# schedule strings in the formats the portal uses less often, and one it
+# shouldn't
+ODD_SCHEDULE_STRINGS = [
+    '0:00 - 0:00 AM; HM Campus',
+    '0:00 - 12:00 PM; PO Campus, TBA',
+    'MW\u00a09:00 - 10:15 AM; HM Campus, Parsons, 1201 (9/3/2024-10/15/2024)',
+    'TR\u00a011:00AM - 12:15 PM; PO Campus, Lincoln, B12',
+    'F\u00a012:00 - 1:00 PM; CM  Campus, Roberts North, 102',
+    'TBA',
+]
+
+def write_portal_page(f, courses, seed=0, messy=False):
+    '''Writes a "show all" Advanced Course Search page listing `courses`
+    courses of one to three sections each; if messy, a few sections are
+    listed twice or have odd schedules or no instructors.'''
+    rng = random.Random(seed)
+    f.write('<html><head><title>Course Search</title></head><body><form id="MAINFORM">\n')
+    f.write('<div class="sidebar">' + '<a href="#">link</a>' * 200 + '</div>\n')
+    f.write('<table id="pg0_V_dgCourses"><thead><tr><th>Add</th><th>Course</th></tr></thead>'
+            '<tbody class="gbody">\n')
+    for i in range(courses):
+        course_id = synthetic_course_id(i)
+        name = 'Synthetic Course {}'.format(i)
+        for section in range(1, rng.randint(1, 3) + 1):
+            row = PORTAL_ROW.format(
+                row_class='' if i % 2 else 'altItem',
+                section_id='{}-{:02d}'.format(course_id, section),
+                name=name,
+                instructors=''.join('<li>Lovelace{}, Ada</li>'.format(rng.randint(0, 200))
+                                     for _ in range(rng.randint(1, 2))),
+                enrolled=rng.randint(0, 30), capacity=30, status=rng.choice(['Open', 'Closed']),
+                schedule=''.join('<li>{}</li>'.format(synthetic_schedule_string(rng))
+                                  for _ in range(rng.randint(1, 2))),
+                credits=rng.choice([1.0, 3.0, 0.5]))
+            if messy:
+                row = mess_up_portal_row(rng, row)
+            f.write(row)
+            if rng.random() < 0.05:
+                f.write(PORTAL_SUB_ROW)
+    f.write('</tbody></table>\n</form></body></html>\n')
+
+def mess_up_portal_row(rng, row):
+    roll = rng.random()
+    if roll < 0.03:
+        return row + row
+    elif roll < 0.08:
+        schedule = ''.join('<li>{}</li>'.format(rng.choice(ODD_SCHEDULE_STRINGS)) for _ in range(rng.randint(1, 2)))
+        start = row.index('<td><ul>', row.index('</td><td>', row.index('/30</td>'))) + len('<td><ul>')
+        return row[:start] + schedule + row[row.index('</ul>', start):]
+    elif roll < 0.10:
+        start = row.index('<td><ul>') + len('<td><ul>')
+        return row[:start] + row[row.index('</ul>', start):]
+    return row
+
+def bench_portal_parse(args):
+    '''Compares the BeautifulSoup and streaming lxml grid parsers on a large
+    synthetic portal page.'''
+    with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False) as f:
+        write_portal_page(f, args.courses)
+    try:
+        with open(f.name) as page:
+            html = page.read()
+        print('page: {} courses, {:.1f} MB'.format(args.courses, len(html) / 1e6))
+        results = []
+        for name, func in [('soup', lambda: scrape.parse_portal_table(scrape.get_portal_table(html))),
+                           ('lxml', lambda: scrape.parse_portal_html(html))]:
+            result, elapsed, peak = measure(func)
+            results.append(result)
+            print('\n{:>10}: {:.2f}s, peak {:.1f} MB'.format(name, elapsed, peak / 1e6))
+        if results[0] != results[1]:
+            print('error: soup and lxml output differ', file=sys.stderr)
+            return 1
+    finally:
+        os.unlink(f.name)
+    return 0
+
+def reference_merge(a, b, path=None):
+    '''merge as it was before list reconciliation used a matching, kept to
+    check the two agree.'''
+    if path is None: path = []
+    for key in b:
+        if key in a:
+            if isinstance(a[key], dict) and isinstance(b[key], dict):
+                reference_merge(a[key], b[key], path + [str(key)])
+                continue
+            if a[key] == b[key]:
+                continue
+            if isinstance(a[key], list) and isinstance(b[key], list):
+                if reference_merge_unordered_lists(a[key], b[key], key == 'instructors'):
+                    continue
+            print('Error: conflict at {}: {!r} != {!r}'.format(
+                        '/'.join(path + [str(key)]), a[key], b[key]), file=sys.stderr)
+        else:
+            a[key] = b[key]
+    return a
+
+def reference_merge_unordered_lists(a, b, allow_substring=False):
+    if a == b:
+        return True
+    if len(a) != len(b):
+        return False
+    merge_map = []
+    for a_itm in a:
+        merge_map.append([i for i, b_itm in enumerate(b) if a_itm == b_itm])
+        if len(merge_map[-1]) == 0:
+            merge_map[-1] = [i for i, b_itm in enumerate(b)
+                             if not b_itm in a and scrape.can_merge(a_itm, b_itm, allow_substring)]
+    idx_list = [0]*len(a)
+    if not reference_get_merge_order(0, idx_list, set(), merge_map):
+        return False
+    for a_i, b_i in enumerate(idx_list):
+        if isinstance(a[a_i], dict) and isinstance(b[b_i], dict):
+            reference_merge(a[a_i], b[b_i])
+    return True
+
+def reference_get_merge_order(a_i, idx_list, idx_set, merge_map):
+    if a_i == len(idx_list):
+        return True
+    for b_i in merge_map[a_i]:
+        if b_i in idx_set:
+            continue
+        idx_set.add(b_i)
+        idx_list[a_i] = b_i
+        if reference_get_merge_order(a_i + 1, idx_list, idx_set, merge_map):
+            return True
+        idx_set.remove(b_i)
+    return False
+
+def synthetic_schedule_part(rng, partial=False):
+    part = {
+        'days': rng.choice(['MW', 'TR', 'MWF', 'F']),
+        'start_time': rng.choice(['09:00:00', '10:00:00', '13:15:00']),
+        'end_time': rng.choice(['09:50:00', '11:15:00', '14:30:00']),
+        'site': rng.choice(['Shanahan', 'Parsons', 'Keck']),
+    }
+    if partial:
+        # what the API leaves out, or has a different idea about
+        for key in rng.sample(sorted(part), rng.randint(1, 3)):
+            del part[key]
+    return part
+
+def synthetic_list_pair(rng, size):
+    '''Two versions of one schedule or instructors list, as portal and API
+    data might disagree about it.'''
+    if rng.random() < 0.5:
+        a = [synthetic_schedule_part(rng) for _ in range(size)]
+        b = [copy.deepcopy(part) if rng.random() < 0.5 else synthetic_schedule_part(rng, partial=True)
+             for part in a]
+    else:
+        a = ['Lovelace{}, Ada'.format(rng.randint(0, size)) for _ in range(size)]
+        b = [name if rng.random() < 0.5 else name[:rng.randint(0, len(name))] for name in a]
+    rng.shuffle(b)
+    if rng.random() < 0.1:
+        b[0] = synthetic_schedule_part(rng) if isinstance(b[0], dict) else 'Nobody'
+    return a, b
+
+def bench_merge_lists(args):
+    '''Checks merge against the old backtracking version on generated list
+    pairs, and times both.'''
+    rng = random.Random(args.seed)
+    pairs = []
+    for _ in range(args.cases):
+        a, b = synthetic_list_pair(rng, rng.randint(1, args.max_list))
+        key = 'instructors' if isinstance(a[0], str) else 'schedule'
+        pairs.append(({key: a}, {key: b}))
+    timings = {}
+    outputs = {}
+    for name, func in [('reference', reference_merge), ('matching', scrape.merge)]:
+        inputs = copy.deepcopy(pairs)
+        errors = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stderr(errors):
+            for a, b in inputs:
+                func(a, b)
+        timings[name] = time.perf_counter() - start
+        outputs[name] = (inputs, errors.getvalue())
+        print('{:>10}: {:.3f}s for {} list pairs'.format(name, timings[name], args.cases))
+    if outputs['reference'] != outputs['matching']:
+        print('error: merge output differs from the reference', file=sys.stderr)
+        return 1
+    return 0
+
+def bench_slot_masks(args):
+    '''Times building a term's slot masks with numpy, checks them against
+    the one-section reference, and times enumerating schedules from them.'''
+    import timeslots
+    page = io.StringIO()
+    write_portal_page(page, args.courses)
+    with contextlib.redirect_stderr(io.StringIO()):
+        classes = scrape.parse_portal_html(page.getvalue())
+    term_masks, elapsed, peak = measure(lambda: timeslots.term_slot_masks(classes))
+    print('   masks: {:.2f}s, peak {:.1f} MB for {} courses'.format(elapsed, peak / 1e6, len(classes)))
+    start = time.perf_counter()
+    for course_id, course in classes.items():
+        for section, section_data in course['sections'].items():
+            if timeslots.decode_section_masks(term_masks[course_id][section]) != \
+                    timeslots.section_slot_masks(section_data):
+                print('error: masks for {} {} differ from the reference'.format(course_id, section),
+                      file=sys.stderr)
+                return 1
+    print('reference: {:.2f}s'.format(time.perf_counter() - start))
+    rng = random.Random(args.seed)
+    course_ids = list(term_masks)
+    start = time.perf_counter()
+    schedules = 0
+    for _ in range(100):
+        for _ in timeslots.term_schedules(term_masks, rng.sample(course_ids, min(5, len(course_ids)))):
+            schedules += 1
+    print('schedules: {} for 100 random 5-course picks in {:.3f}s'.format(schedules, time.perf_counter() - start))
+    return 0
+
+def bench_compact_term(args):
+    '''Compares the memory a parsed term takes as plain dicts and in the
+    compact form finished terms are kept in, checking the compact form
+    expands back to the same data and serializes to the same JSON.'''
+    page = io.StringIO()
+    write_portal_page(page, args.courses, args.seed, args.messy)
+    with contextlib.redirect_stderr(io.StringIO()):
+        classes = scrape.parse_portal_html(page.getvalue())
+    _, _, plain_peak = measure(lambda: copy.deepcopy(classes))
+    compact, elapsed, compact_peak = measure(lambda: scrape.compact_term(classes))
+    print('  plain: {:.1f} MB for {} courses'.format(plain_peak / 1e6, len(classes)))
+    print('compact: {:.1f} MB, {:.2f}s to build'.format(compact_peak / 1e6, elapsed))
+    if scrape.expand_compact(compact) != classes:
+        print('error: the compact term does not expand back to the parsed one', file=sys.stderr)
+        return 1
+    if json.dumps(compact, default=scrape.compact_to_json) != json.dumps(classes):
+        print('error: the compact term serializes differently', file=sys.stderr)
+        return 1
+    return 0
+
+def bench_delta_order(args):
+    '''Times diffing a term against a version missing a course from its
+    middle and a section from the front of another course, and one with a
+    course the new one dropped, checking the delta brings the old version
+    to the new one with its courses and sections in the same order.'''
+    page = io.StringIO()
+    write_portal_page(page, args.courses, args.seed, args.messy)
+    with contextlib.redirect_stderr(io.StringIO()):
+        classes = scrape.parse_portal_html(page.getvalue())
+    # as the files have it, with the section numbers as strings
+    new = json.loads(json.dumps(classes))
+    old = copy.deepcopy(new)
+    ids = list(old)
+    if len(ids) < 3:
+        print('error: delta-order needs at least 3 courses', file=sys.stderr)
+        return 1
+    del old[ids[len(ids) // 2]]
+    sections = old[ids[0]]['sections']
+    del sections[next(iter(sections))]
+    old['ZZZZ999  ZZ'] = copy.deepcopy(new[ids[-1]])
+    start = time.perf_counter()
+    changes = delta.diff_term(old, new)
+    order = delta.order(old, new)
+    diffed = time.perf_counter() - start
+    applied = copy.deepcopy(old)
+    start = time.perf_counter()
+    delta.apply(applied, changes, keys=order)
+    elapsed = time.perf_counter() - start
+    size = len(json.dumps({'courses': changes, 'order': order}))
+    print('delta: {} changes, {} bytes, {:.3f}s to diff, {:.3f}s to apply'.format(
+        len(changes), size, diffed, elapsed))
+    if not delta.same(applied, new):
+        print('error: the delta does not bring the old term to the new one in order', file=sys.stderr)
+        return 1
+    return 0
+
+def run_stage(setup, func):
+    '''Times func(setup()) and then, on fresh input, measures its peak
+    memory; tracing memory slows it down too much to do both at once.'''
+    data = setup()
+    start = time.perf_counter()
+    func(data)
+    elapsed = time.perf_counter() - start
+    data = setup()
+    _, _, peak = measure(lambda: func(data))
+    return elapsed, peak
+
+def scale_stages(html, api_path):
+    '''(stage, items, setup, func) for each hot path, on one page and API
+    payload; setup makes the input, func is what is measured.'''
+    classes = scrape.parse_portal_html(html)
+    sections = [section for course in classes.values() for section in course['sections'].values()]
+    api_classes_by_term = scrape.format_api_data_as_portal_data(
+        scrape.iter_json_array_items(file_chunks(api_path), 'data'))
+    term = 'FA  2024'
+    return [
+        ('parse_portal_table', len(sections), lambda: html,
+         lambda html: scrape.parse_portal_table(scrape.get_portal_table(html))),
+        ('parse_portal_html', len(sections), lambda: html, scrape.parse_portal_html),
+        ('parse_section_id', len(sections), lambda: [section['section_id'] for section in sections],
+         lambda section_ids: [scrape.parse_section_id(section_id) for section_id in section_ids]),
+        ('parse_schedule', len(sections),
+         lambda: [(section['scheduleStrings'], section['startDate'], section['endDate']) for section in sections],
+         lambda args: [scrape.parse_schedule(*section_args) for section_args in args]),
+        ('format_api_data', sum(len(course.get('sections', ())) for classes in api_classes_by_term.values()
+                                for course in classes.values()),
+         lambda: api_path,
+         lambda path: scrape.format_api_data_as_portal_data(scrape.iter_json_array_items(file_chunks(path), 'data'))),
+        ('merge', len(sections), lambda: (copy.deepcopy(classes), api_classes_by_term.get(term, {})),
+         lambda pair: scrape.merge(pair[0], pair[1], [term])),
+    ]
+
+def bench_scale(args):
+    '''Runs the scraper's hot paths on synthetic portal pages and API
+    payloads of each size in --sections, printing time, throughput and
+    peak memory per stage; --save keeps the results and --compare prints
+    them against a saved run.'''
+    results = []
+    for target in args.sections:
+        # the page averages two sections a course
+        courses = max(1, target // 2)
+        page = io.StringIO()
+        write_portal_page(page, courses, args.seed, args.messy)
+        html = page.getvalue()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            write_api_payload(f, courses, args.seed, args.messy)
+        try:
+            # the scraper complains about messy input on stderr
+            with contextlib.redirect_stderr(io.StringIO()):
+                stages = scale_stages(html, f.name)
+            print('{} courses: page {:.1f} MB, API payload {:.1f} MB'.format(
+                  courses, len(html) / 1e6, os.path.getsize(f.name) / 1e6))
+            for stage, items, setup, func in stages:
+                if stage not in args.stages:
+                    continue
+                scrape.REPORT.drain_warnings()
+                with contextlib.redirect_stderr(io.StringIO()):
+                    elapsed, peak = run_stage(setup, func)
+                warnings = scrape.REPORT.drain_warnings()
+                result = {'sections': target, 'messy': args.messy, 'stage': stage, 'items': items,
+                          'seconds': elapsed, 'per_second': items / max(elapsed, 1e-9), 'peak_mb': peak / 1e6,
+                          # each of run_stage's two passes' complaints about
+                          # messy input
+                          'warnings': warnings // 2}
+                results.append(result)
+                print('  {stage:>18}: {seconds:8.3f}s {per_second:10.0f}/s  peak {peak_mb:7.1f} MB'
+                      '  {warnings} warnings'.format(**result))
+        finally:
+            os.unlink(f.name)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'seed': args.seed,
+                       'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {(result['sections'], result['messy'], result['stage']): result
+                        for result in json.load(f)['results']}
+        print('\ncompared with {}:'.format(args.compare))
+        for result in results:
+            before = previous.get((result['sections'], result['messy'], result['stage']))
+            if before is not None:
+                print('  {:>7} {:>18}: time x{:.2f}, peak memory x{:.2f}'.format(
+                      result['sections'], result['stage'], result['seconds'] / max(before['seconds'], 1e-9),
+                      result['peak_mb'] / max(before['peak_mb'], 1e-9)))
+    return 0
+
+# what importing scrape must not pull in; each function that needs one
+# imports it itself
+LAZY_MODULES = ['splinter', 'bs4', 'lxml', 'requests', 'multiprocessing', 'subprocess']
+IMPORT_TIME_RE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)$')
+
+def bench_import_time(args):
+    '''Imports scrape in fresh interpreters, printing the median time and
+    the slowest modules it imports; fails if that is over --max-import-ms
+    or if it imports any of LAZY_MODULES.'''
+    code = 'import sys, scrape; print(" ".join(sorted(sys.modules)))'
+    directory = os.path.dirname(os.path.abspath(scrape.__file__))
+    totals = []
+    cumulative = {}
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=directory,
+                                capture_output=True, text=True, check=True)
+        # a module's imports are listed before it, the interpreter's own
+        # startup imports before those
+        run = []
+        for line in result.stderr.splitlines():
+            m = IMPORT_TIME_RE.match(line)
+            if not m:
+                continue
+            run.append((m.group(4), int(m.group(2))))
+            if not m.group(3):
+                if m.group(4) == 'scrape':
+                    break
+                run = []
+        for name, microseconds in run:
+            cumulative.setdefault(name, []).append(microseconds)
+        totals.append(cumulative['scrape'][-1] / 1000)
+        modules = result.stdout.split()
+    print('import scrape: median {:.1f} ms over {} runs (min {:.1f} ms)'.format(
+          statistics.median(totals), len(totals), min(totals)))
+    slowest = sorted(cumulative.items(), key=lambda item: -statistics.median(item[1]))
+    for name, times in slowest[:args.top]:
+        print('  {:>30}: {:7.1f} ms'.format(name, statistics.median(times) / 1000))
+    status = 0
+    loaded = [name for name in LAZY_MODULES if name in modules]
+    if loaded:
+        print('error: importing scrape imports {}'.format(', '.join(loaded)), file=sys.stderr)
+        status = 1
+    if args.max_import_ms is not None and statistics.median(totals) > args.max_import_ms:
+        print('error: import takes over {} ms'.format(args.max_import_ms), file=sys.stderr)
+        status = 1
+    return status
+
+FAULTS = ['error', 'garbage', 'hang', 'drop']
+
+class FaultyServer(http.server.ThreadingHTTPServer):
+    '''Serves body (gzipped if asked) to every GET, except that a
+    fault_rate share of requests get one of FAULTS instead: a 503, a
+    response that isn't JSON, no response for hang_seconds, or a dropped
+    connection.'''
+    daemon_threads = True
+
+    def __init__(self, body, fault_rate, hang_seconds, seed=0):
+        super().__init__(('127.0.0.1', 0), FaultyHandler)
+        self.body = body
+        self.gzipped = gzip.compress(body, mtime=0)
+        self.fault_rate = fault_rate
+        self.hang_seconds = hang_seconds
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.served = dict.fromkeys(['ok'] + FAULTS, 0)
+
+    def next_fault(self):
+        with self.lock:
+            fault = self.rng.choice(FAULTS) if self.rng.random() < self.fault_rate else 'ok'
+            self.served[fault] += 1
+            return fault
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+class FaultyHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        fault = self.server.next_fault()
+        if fault == 'hang':
+            time.sleep(self.server.hang_seconds)
+            self.close_connection = True
+        elif fault == 'drop':
+            self.close_connection = True
+        elif fault == 'error':
+            self.send_error(503)
+        else:
+            body = b'<html>Unauthorized</html>' if fault == 'garbage' else self.server.body
+            self.send_response(200)
+            if fault == 'ok' and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = self.server.gzipped
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def bench_fetch_faults(args):
+    '''Fetches a synthetic API payload --runs times from a local server that
+    fails --fault-rate of requests, checking every fetch gets all of it,
+    then has the server fail everything to check the circuit breaker.
+    Timeouts and backoff are scaled down so this takes seconds.'''
+    payload = io.StringIO()
+    write_api_payload(payload, args.courses, args.seed)
+    server = FaultyServer(payload.getvalue().encode('utf-8'), args.fault_rate, hang_seconds=2, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scrape.API_BASE_URL = server.url
+    scrape.API_TIMEOUT = (1, 0.5)
+    scrape.API_BACKOFF_BASE = 0.05
+    scrape.API_BACKOFF_MAX = 0.5
+    scrape.MAX_RETRIES = 12
+    status = 0
+    try:
+        start = time.perf_counter()
+        failed = 0
+        for _ in range(args.runs):
+            try:
+                with contextlib.redirect_stderr(io.StringIO()):
+                    courses = sum(1 for _ in scrape.fetch_api_courses())
+            except Exception as err:
+                print('  fetch failed: {!r}'.format(err))
+                failed += 1
+                continue
+            if courses != args.courses:
+                print('error: got {} of {} courses'.format(courses, args.courses), file=sys.stderr)
+                status = 1
+        elapsed = time.perf_counter() - start
+        totals = scrape.REPORT.totals()['api_fetch']
+        print('{} fetches at fault rate {}: {} failed, {} failed attempts, {:.2f}s backing off, {:.2f}s in all'.format(
+              args.runs, args.fault_rate, failed, totals['retries'], totals['backoff_seconds'], elapsed))
+        print('  served: {}'.format(', '.join('{} {}'.format(count, name) for name, count in server.served.items())))
+
+        # the site is down: after threshold failures, fetches stop trying
+        server.fault_rate = 1
+        breaker = fetching.CircuitBreaker(threshold=5, reset_after=60)
+        policy = fetching.RetryPolicy(3, 0.01, 0.05)
+        session = fetching.session('bench')
+        outcomes = collections.Counter()
+        start = time.perf_counter()
+        for _ in range(10):
+            try:
+                fetching.retry(lambda: session.get(server.url, timeout=(1, 0.5)).json(), policy, breaker)
+            except fetching.CircuitOpen:
+                outcomes['not tried'] += 1
+            except Exception:
+                outcomes['failed'] += 1
+        print('site down: {} failed, {} not tried, breaker opened {} times, {:.2f}s in all'.format(
+              outcomes['failed'], outcomes['not tried'], breaker.trips, time.perf_counter() - start))
+        if not breaker.trips:
+            print('error: the circuit breaker never opened', file=sys.stderr)
+            status = 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    return status
+
+PORTAL_PATH = '/ICS/default.aspx'
+PORTAL_FORM = '''<html><head><title>Course Search</title></head><body>
+<form name="MAINFORM" method="post" action="./default.aspx?portlet=Course_Schedules" id="MAINFORM">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{validation}" />
+<select name="pg0$V$ddlTerm" id="pg0_V_ddlTerm" onchange="javascript:__doPostBack('pg0$V$ddlTerm','')">{terms}</select>
+<select name="pg0$V$ddlAdditional" id="pg0_V_ddlAdditional"><option value="">\u00a0</option>{areas}</select>
+<input name="pg0$V$txtTitleRestrictor" type="text" id="pg0_V_txtTitleRestrictor" />
+<input type="submit" name="pg0$V$btnSearch" value="Search" id="pg0_V_btnSearch" />
+{results}
+</form></body></html>
+'''
+PORTAL_SHOW_ALL = '''<p>Showing 1 - 25</p>
+<a id="pg0_V_lnkShowAll" href="javascript:__doPostBack('pg0$V$lnkShowAll','')">Show all</a>'''
+
+class StandInPortal(http.server.ThreadingHTTPServer):
+    '''Serves the Advanced Course Search form the way the portal does, as
+    ASP.NET postbacks: the state of the form is carried in __VIEWSTATE,
+    which must come back with the __EVENTVALIDATION issued for it, and
+    changing the term reloads the form. pages maps (term, course area or
+    None) to the "show all" results page of that search. Like the portal,
+    it sends no charset, so the pages must be decoded from their bytes.'''
+    daemon_threads = True
+
+    def __init__(self, pages):
+        super().__init__(('127.0.0.1', 0), StandInPortalHandler)
+        self.pages = pages
+        self.terms = sorted({term for term, _ in pages}, key=scrape.term_sort)
+        self.areas = sorted({area for _, area in pages if area is not None})
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+    def term_value(self, term):
+        return term.replace(' ', '')
+
+    def validation(self, viewstate):
+        return hashlib.sha256(b'stand-in' + viewstate.encode('ascii')).hexdigest()[:16]
+
+    def form(self, state, results=''):
+        viewstate = base64.b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+        return PORTAL_FORM.format(
+            viewstate=viewstate, validation=self.validation(viewstate),
+            terms=''.join('<option{} value="{}">{}</option>'.format(
+                ' selected="selected"' if self.term_value(term) == state['term'] else '',
+                self.term_value(term), html.escape(term)) for term in self.terms),
+            areas=''.join('<option value="{}">{}</option>'.format(i, html.escape(area))
+                          for i, area in enumerate(self.areas)),
+            results=results).encode('utf-8')
+
+    def count(self, rejected=False):
+        with self.lock:
+            self.requests += 1
+            self.rejected += rejected
+
+    @property
+    def url(self):
+        return 'http://{}:{}{}?portlet=Course_Schedules'.format(*self.server_address, PORTAL_PATH)
+
+class StandInPortalHandler(http.server.BaseHTTPRequestHandler):
+    def send_page(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reject(self, reason):
+        self.server.count(rejected=True)
+        self.send_error(500, reason)
+
+    def do_GET(self):
+        self.server.count()
+        # the last term is selected, so fetching any other posts it back
+        self.send_page(self.server.form({'term': self.server.term_value(self.server.terms[-1]), 'search': None}))
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('ascii')
+        fields = dict(urllib.parse.parse_qsl(body, keep_blank_values=True))
+        viewstate = fields.get('__VIEWSTATE', '')
+        if fields.get('__EVENTVALIDATION') != server.validation(viewstate):
+            return self.reject('Invalid postback or callback argument')
+        state = json.loads(base64.b64decode(viewstate))
+        target = fields.get('__EVENTTARGET')
+        terms = {server.term_value(term): term for term in server.terms}
+        if target == 'pg0$V$ddlTerm':
+            if fields.get('pg0$V$ddlTerm') not in terms:
+                return self.reject('no such term')
+            server.count()
+            self.send_page(server.form({'term': fields['pg0$V$ddlTerm'], 'search': None}))
+        elif 'pg0$V$btnSearch' in fields:
+            if fields.get('pg0$V$ddlTerm') != state['term']:
+                # a term must be chosen (and the form reloaded) first
+                return self.reject('term changed without a postback')
+            area = fields.get('pg0$V$ddlAdditional', '')
+            area = server.areas[int(area)] if area else None
+            if area is None and fields.get('pg0$V$txtTitleRestrictor') != '*':
+                return self.reject('nothing to search for')
+            server.count()
+            self.send_page(server.form({'term': state['term'], 'search': [terms[state['term']], area]},
+                                       PORTAL_SHOW_ALL))
+        elif target == 'pg0$V$lnkShowAll' and state['search'] is not None:
+            server.count()
+            self.send_page(server.pages[tuple(state['search'])])
+        else:
+            self.reject('unexpected postback')
+
+    def log_message(self, *args):
+        pass
+
+def bench_portal_postback(args):
+    '''Fetches every search of a stand-in portal with the browserless fetch
+    engine, checking each page comes back exactly as served.'''
+    pages = {}
+    for i, (term, area) in enumerate([('FA  2024', None), ('SP  2025', None), ('FA  2024', 'Area A'),
+                                      ('SP  2025', 'Area B')]):
+        page = io.StringIO()
+        write_portal_page(page, args.courses if area is None else max(args.courses // 20, 1), seed=args.seed + i)
+        pages[term, area] = page.getvalue().encode('utf-8')
+    server = StandInPortal(pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scrape.PORTAL_URL = server.url
+    status = 0
+    worker = scrape.HttpPortalWorker()
+    try:
+        start = time.perf_counter()
+        for (term, area), page in pages.items():
+            with contextlib.redirect_stderr(io.StringIO()):
+                fetched = worker.fetch(term, area)
+            if fetched != page.decode('utf-8'):
+                print('error: {} {} came back different'.format(term, area or ''), file=sys.stderr)
+                status = 1
+        elapsed = time.perf_counter() - start
+        print('{} searches in {} requests ({} rejected), {:.3f}s/search'.format(
+              len(pages), server.requests, server.rejected, elapsed / len(pages)))
+        if server.rejected:
+            status = 1
+    finally:
+        worker.recycle()
+        server.shutdown()
+        server.server_close()
+    return status
+
+SCALE_STAGES = ['parse_portal_table', 'parse_portal_html', 'parse_section_id', 'parse_schedule',
+                'format_api_data', 'merge']
+
+BENCHMARKS = {
+    'api-memory': bench_api_memory,
+    'compact-term': bench_compact_term,
+    'delta-order': bench_delta_order,
+    'fetch-faults': bench_fetch_faults,
+    'import-time': bench_import_time,
+    'merge-lists': bench_merge_lists,
+    'portal-parse': bench_portal_parse,
+    'portal-postback': bench_portal_postback,
+    'scale': bench_scale,
+    'slot-masks': bench_slot_masks,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--courses', type=int, default=5000, action='store')
+    parser.add_argument('--cases', type=int, default=2000, action='store')
+    parser.add_argument('--max-list', type=int, default=8, action='store')
+    parser.add_argument('--seed', type=int, default=0, action='store')
+    parser.add_argument('--sections', type=int, nargs='+', default=[1000, 10000], action='store',
+                        help='page sizes for the scale benchmark (e.g. 1000 10000 100000)')
+    parser.add_argument('--messy', action='store_true',
+                        help='include duplicate sections, odd schedules and mismatched API data')
+    parser.add_argument('--stages', choices=SCALE_STAGES, nargs='+', default=SCALE_STAGES, action='store')
+    parser.add_argument('--save', action='store', help='write the scale results here as JSON')
+    parser.add_argument('--compare', action='store', help='compare the scale results with a saved run')
+    parser.add_argument('--runs', type=int, default=10, action='store',
+                        help='interpreters to start for import-time, fetches for fetch-faults')
+    parser.add_argument('--fault-rate', type=float, default=0.3, action='store',
+                        help='share of requests the fetch-faults server fails')
+    parser.add_argument('--top', type=int, default=10, action='store',
+                        help='slowest imports to list in the import-time benchmark')
+    parser.add_argument('--max-import-ms', type=float, action='store',
+                        help='fail the import-time benchmark if importing scrape takes longer')
+    args = parser.parse_args()
+    sys.exit(BENCHMARKS[args.benchmark](args))
+
+if __name__ == '__main__':
+    main()
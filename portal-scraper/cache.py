@@ -0,0 +1,113 @@
+'''On-disk cache of parsed and merged term data, keyed by content hashes of
+the inputs, plus the atomic, skip-if-unchanged file writes used for all
+published output.'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+# entries not used for this long are removed by prune()
+MAX_AGE = 30 * 24 * 60 * 60
+
+def content_hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8') if isinstance(part, str) else part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+class ContentCache:
+    '''Pickled values by key; a cache with no directory stores nothing.
+
+    Values are pickled rather than JSON-encoded so that they come back
+    exactly as they went in (integer section numbers, OrderedDicts).
+    Keys made by key() include a hash of the file at code_path, the code
+    that makes the values, so a change to it (a parsing fix, say) is not
+    hidden by values the old code made; those go unused and are pruned.'''
+    def __init__(self, directory=None, code_path=None):
+        self.directory = directory
+        self.code_path = code_path
+        self.code_hash = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        '''The key of the value the code makes from parts.'''
+        if self.code_hash is None:
+            with open(self.code_path, 'rb') as f:
+                self.code_hash = content_hash(f.read())
+        return content_hash(self.code_hash, *parts)
+
+    def drain_stats(self):
+        '''Returns and resets (hits, misses), for sending back from a worker
+        process.'''
+        stats = (self.hits, self.misses)
+        self.hits = self.misses = 0
+        return stats
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pickle')
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # keep entries in use from being pruned
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        if self.directory is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def prune(self, max_age=MAX_AGE):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - max_age
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+
+def atomic_write(path, data):
+    '''Writes data to path so readers see either the old file or the new
+    one, never a partial write.'''
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def write_if_changed(path, data):
+    '''atomic_write, unless the file already holds exactly these bytes;
+    returns whether it wrote.'''
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    atomic_write(path, data)
+    return True
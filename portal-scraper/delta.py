@@ -0,0 +1,114 @@
+'''Deltas between published versions of a term, so a client holding one
+version of <term>.json can catch up by fetching only what changed.
+
+A version is named by the first VERSION_LENGTH hex digits of the sha256
+of the term's file, which the manifest already lists. Each time the file
+changes, <term>_delta_<old version>.json is written. It holds {"from":
+old version, "to": new version, "order": [course id], "courses":
+changes}, where changes maps a course id to one of:
+
+  - null, if the course was removed,
+  - {"full": course}, if it was added, or
+  - {"set": {field: value}, "unset": [field], "sections": changes,
+    "order": [section]}, with only the fields that changed, and the
+    course's sections mapped the same way (a section's changes have no
+    "sections").
+
+"order" is there only when the ids (of the courses, or of a course's
+sections) are not the old ones in the old order, and lists all of them
+in their new order, so that added courses and sections land in their
+place rather than at the end.
+
+A client further behind follows the chain of deltas, one version at a
+time. Applying a delta only sets and deletes values, so applying it to
+data that already has some of its changes does no harm. applyDelta() in
+scheduler.js is the client side of apply().'''
+
+import hashlib
+
+VERSION_LENGTH = 16
+NESTED = 'sections'
+
+def version(data):
+    '''The version name of a published file's bytes.'''
+    return hashlib.sha256(data).hexdigest()[:VERSION_LENGTH]
+
+def file_name(term, from_version):
+    return '{}_delta_{}.json'.format(term, from_version)
+
+def diff_record(old, new, nested):
+    change = {}
+    changed = {key: value for key, value in new.items() if key != nested and (key not in old or old[key] != value)}
+    if changed:
+        change['set'] = changed
+    removed = [key for key in old if key != nested and key not in new]
+    if removed:
+        change['unset'] = removed
+    if nested is not None:
+        nested_changes = diff(old.get(nested, {}), new.get(nested, {}))
+        if nested_changes:
+            change[nested] = nested_changes
+        nested_order = order(old.get(nested, {}), new.get(nested, {}))
+        if nested_order is not None:
+            change['order'] = nested_order
+    return change
+
+def order(old, new):
+    '''The keys of new in order, if they aren't those of old in order.'''
+    return list(new) if list(old) != list(new) else None
+
+def diff(old, new, nested=None):
+    '''The changes taking old (id -> record) to new; records' nested key
+    holds another such map, diffed the same way.'''
+    changes = {}
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    for key, record in new.items():
+        if key not in old:
+            changes[key] = {'full': record}
+        else:
+            change = diff_record(old[key], record, nested)
+            if change:
+                changes[key] = change
+    return changes
+
+def diff_term(old, new):
+    return diff(old, new, NESTED)
+
+def same(old, new, nested=NESTED):
+    '''Whether records old and new are equal with their keys, and those of
+    their nested records, in the same order (the order of the fields in a
+    record doesn't count).'''
+    return (old == new and list(old) == list(new) and
+            (nested is None or all(list(old[key].get(nested, {})) == list(record.get(nested, {}))
+                                   for key, record in new.items())))
+
+def reorder(records, keys):
+    '''Puts records' keys in the given order, in place; any not given stay
+    after them.'''
+    items = dict(records)
+    records.clear()
+    for key in keys:
+        if key in items:
+            records[key] = items.pop(key)
+    records.update(items)
+
+def apply(records, changes, nested=NESTED, keys=None):
+    '''Applies changes (of diff_term()) to records, in place, and puts
+    them in the order keys gives, if any.'''
+    for key, change in changes.items():
+        if change is None:
+            records.pop(key, None)
+        elif 'full' in change:
+            records[key] = change['full']
+        else:
+            record = records.setdefault(key, {})
+            record.update(change.get('set', {}))
+            for field in change.get('unset', ()):
+                record.pop(field, None)
+            if nested in change or 'order' in change:
+                apply(record.setdefault(nested, {}), change.get(nested, {}), None, change.get('order'))
+    if keys is not None:
+        reorder(records, keys)
+    return records
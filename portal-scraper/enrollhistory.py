@@ -0,0 +1,230 @@
+'''Append-only history of each term's enrollment figures across scrape runs,
+so questions like "how fast do sections fill" don't need archived copies
+of every <term>.json.
+
+Each term's history is a directory holding:
+
+  times.i8       the time of each snapshot (int64 Unix seconds), appended
+  changes.bin    CHANGE_DTYPE records, appended in snapshot order
+  sections.json  [course id, section] of each section, numbered in the
+                 order they were first seen
+  statuses.json  each status string, numbered the same way
+
+A snapshot only adds a record for a section whose enrollment, capacity or
+status differs from its last record, so a snapshot every minute through
+registration costs 8 bytes plus 18 per change. A section missing from a
+snapshot gets a record with every value MISSING (once), as it would if
+its figures were blank. Both files are read through memory maps, and
+since records are in time order, a time range is a binary search away.'''
+
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+
+import cache
+
+CHANGE_DTYPE = np.dtype([('snapshot', '<u4'), ('section', '<u4'), ('enrollment', '<i4'),
+                         ('capacity', '<i4'), ('status', '<i2')])
+TIME_DTYPE = np.dtype('<i8')
+VALUE_FIELDS = ('enrollment', 'capacity', 'status')
+# a blank figure or status, or a section gone from the term
+MISSING = -1
+
+def read_array(path, dtype):
+    '''The records in path, memory-mapped; empty if there are none yet.'''
+    if not os.path.exists(path) or os.path.getsize(path) < dtype.itemsize:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(os.path.getsize(path) // dtype.itemsize,))
+
+def last_rows(changes):
+    '''The last of changes for each section they include.'''
+    sections = changes['section'][::-1]
+    _, reversed_index = np.unique(sections, return_index=True)
+    return changes[len(changes) - 1 - reversed_index]
+
+class EnrollmentHistory:
+    '''The history of one term, stored in directory.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.sections = self.read_list('sections.json')
+        self.section_index = {tuple(key): i for i, key in enumerate(self.sections)}
+        self.statuses = self.read_list('statuses.json')
+        self.status_index = {status: i for i, status in enumerate(self.statuses)}
+        # each section's last values and whether it has any, made on first use
+        self.latest = None
+        self.recorded = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_list(self, name):
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def times(self):
+        return read_array(self.path('times.i8'), TIME_DTYPE)
+
+    def changes(self):
+        '''Every record, leaving out any written after the last complete
+        snapshot (an append cut short).'''
+        changes = read_array(self.path('changes.bin'), CHANGE_DTYPE)
+        return changes[:np.searchsorted(changes['snapshot'], len(self.times()))]
+
+    def latest_values(self):
+        '''Array of each section's last recorded values, one row per section,
+        MISSING for sections not yet recorded.'''
+        if self.latest is None:
+            self.latest = np.full((len(self.sections), len(VALUE_FIELDS)), MISSING, dtype=np.int64)
+            self.recorded = np.zeros(len(self.sections), dtype=bool)
+            last = last_rows(self.changes())
+            for column, field in enumerate(VALUE_FIELDS):
+                self.latest[last['section'], column] = last[field]
+            self.recorded[last['section']] = True
+        if len(self.latest) < len(self.sections):
+            added = len(self.sections) - len(self.latest)
+            self.latest = np.vstack([self.latest, np.full((added, len(VALUE_FIELDS)), MISSING, dtype=np.int64)])
+            self.recorded = np.concatenate([self.recorded, np.zeros(added, dtype=bool)])
+        return self.latest
+
+    def number(self, value, index, names):
+        if value is None:
+            return MISSING
+        if value not in index:
+            index[value] = len(names)
+            names.append(value)
+        return index[value]
+
+    def append(self, table, timestamp):
+        '''Records a snapshot of an enrollment table (as scrape.py's
+        enrollment_table() makes) taken at timestamp; returns the number of
+        sections that changed.'''
+        fields = table['fields']
+        columns = [fields.index(field) for field in ('currentEnrollment', 'capacity', 'status')]
+        known_sections, known_statuses = len(self.sections), len(self.statuses)
+        present = []
+        values = []
+        for course_id, sections in table['courses'].items():
+            for section, figures in sections.items():
+                present.append(self.number((course_id, str(section)), self.section_index, self.sections))
+                enrollment, capacity, status = (figures[column] for column in columns)
+                values.append((MISSING if enrollment is None else enrollment,
+                               MISSING if capacity is None else capacity,
+                               self.number(status, self.status_index, self.statuses)))
+        latest = self.latest_values()
+        present = np.array(present, dtype=np.int64)
+        values = np.array(values, dtype=np.int64).reshape(-1, len(VALUE_FIELDS))
+        changed = ~self.recorded[present] | (values != latest[present]).any(axis=1)
+        gone = np.ones(len(self.sections), dtype=bool)
+        gone[present] = False
+        gone &= self.recorded & (latest != MISSING).any(axis=1)
+        rows = np.concatenate([present[changed], np.flatnonzero(gone)])
+        records = np.zeros(len(rows), dtype=CHANGE_DTYPE)
+        records['snapshot'] = len(self.times())
+        records['section'] = rows
+        new_values = np.vstack([values[changed], np.full((gone.sum(), len(VALUE_FIELDS)), MISSING, dtype=np.int64)])
+        for column, field in enumerate(VALUE_FIELDS):
+            records[field] = new_values[:, column]
+        os.makedirs(self.directory, exist_ok=True)
+        # names first and the snapshot time last, so an append cut short
+        # leaves records that changes() ignores
+        if len(self.sections) > known_sections:
+            cache.atomic_write(self.path('sections.json'), json.dumps(self.sections).encode('utf-8'))
+        if len(self.statuses) > known_statuses:
+            cache.atomic_write(self.path('statuses.json'), json.dumps(self.statuses).encode('utf-8'))
+        self.truncate_partial()
+        with open(self.path('changes.bin'), 'ab') as f:
+            f.write(records.tobytes())
+        with open(self.path('times.i8'), 'ab') as f:
+            f.write(np.array([timestamp], dtype=TIME_DTYPE).tobytes())
+        latest[rows] = new_values
+        self.recorded[rows] = True
+        return len(rows)
+
+    def truncate_partial(self):
+        '''Cuts off whatever an append cut short left at the ends of the files.'''
+        times_path = self.path('times.i8')
+        if os.path.exists(times_path) and os.path.getsize(times_path) % TIME_DTYPE.itemsize:
+            os.truncate(times_path, len(self.times()) * TIME_DTYPE.itemsize)
+        changes_path = self.path('changes.bin')
+        if os.path.exists(changes_path):
+            size = len(self.changes()) * CHANGE_DTYPE.itemsize
+            if os.path.getsize(changes_path) != size:
+                os.truncate(changes_path, size)
+
+    def select(self, course_prefix='', section=None):
+        '''Numbers of the sections of courses whose id starts with
+        course_prefix (a department such as "CSCI", or a whole course id),
+        only the given section if any.'''
+        return np.array([i for i, (course_id, number) in enumerate(self.sections)
+                         if course_id.startswith(course_prefix) and (section is None or number == section)],
+                        dtype=np.int64)
+
+    def query(self, sections=None, since=None, until=None):
+        '''(times, records) of the changes to the given sections (all, if
+        None) from since to until, in Unix seconds, each preceded by the
+        section's last record from before since.'''
+        times = self.times()
+        changes = self.changes()
+        first = 0 if since is None else np.searchsorted(times, since, 'left')
+        end = len(times) if until is None else np.searchsorted(times, until, 'right')
+        lo, hi = np.searchsorted(changes['snapshot'], [first, end], 'left')
+        before, window = changes[:lo], changes[lo:hi]
+        if sections is not None:
+            before = before[np.isin(before['section'], sections)]
+            window = window[np.isin(window['section'], sections)]
+        records = np.concatenate([last_rows(before), window])
+        return times[records['snapshot']], records
+
+    def fill_times(self, sections=None):
+        '''{section number: time the section first filled} for sections
+        that have been full.'''
+        times, records = self.query(sections)
+        full = records[(records['capacity'] > 0) & (records['enrollment'] >= records['capacity'])]
+        # records of each section are in time order, after the one from
+        # before since (and there is no since here)
+        numbers, first = np.unique(full['section'], return_index=True)
+        return dict(zip(numbers.tolist(), self.times()[full['snapshot'][first]].tolist()))
+
+def parse_time(text):
+    '''Unix seconds of an ISO date or time, taken as UTC if no zone is given.'''
+    value = datetime.datetime.fromisoformat(text)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp())
+
+def format_time(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+def main():
+    parser = argparse.ArgumentParser(description='query the enrollment history scrape.py --history keeps')
+    parser.add_argument('directory', help='the --history directory')
+    parser.add_argument('term')
+    parser.add_argument('--course', default='', action='store',
+                        help='only courses whose id starts with this (e.g. a department, "CSCI")')
+    parser.add_argument('--section', action='store')
+    parser.add_argument('--since', type=parse_time, action='store', help='ISO date or time (UTC)')
+    parser.add_argument('--until', type=parse_time, action='store', help='ISO date or time (UTC)')
+    parser.add_argument('--fill', action='store_true', help='list when each section filled')
+    args = parser.parse_args()
+    history = EnrollmentHistory(os.path.join(args.directory, args.term))
+    sections = history.select(args.course, args.section)
+    if args.fill:
+        fills = history.fill_times(sections)
+        for number, time in sorted(fills.items(), key=lambda item: item[1]):
+            print('{}\t{}\t{}'.format(format_time(time), *history.sections[number]))
+        return
+    times, records = history.query(sections, args.since, args.until)
+    for time, record in zip(times.tolist(), records):
+        values = [None if record[field] == MISSING else int(record[field]) for field in VALUE_FIELDS]
+        status = None if values[2] is None else history.statuses[values[2]]
+        print('{}\t{}\t{}\t{}/{}\t{}'.format(format_time(time), *history.sections[record['section']],
+                                              values[0], values[1], status))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''Retries with exponential backoff and jitter, a circuit breaker, and the
+keep-alive HTTP sessions shared by the API and portal fetches.
+
+retry() calls a fetch until it succeeds or runs out of attempts. After the
+n-th failure in a row it sleeps a random time between 0 and base_delay *
+2**(n-1) seconds, capped at max_delay. The randomness keeps workers that
+failed together from all retrying at the same moment.
+
+A CircuitBreaker is shared by all fetches from one site. It opens after
+threshold failures in a row. While it is open, fetches fail at once with
+CircuitOpen instead of waiting out their own retries. Once reset_after
+seconds have passed, one fetch is let through to try the site again.'''
+
+import random
+import time
+
+class CircuitOpen(Exception):
+    pass
+
+class RetryPolicy:
+    def __init__(self, attempts, base_delay=1.0, max_delay=60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, failures):
+        '''Seconds to wait after the given number of failures in a row.'''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failures - 1)))
+
+class CircuitBreaker:
+    def __init__(self, threshold, reset_after, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    def check(self):
+        '''Raises CircuitOpen if fetches should not be tried now.'''
+        if self.opened_at is None:
+            return
+        if self.clock() - self.opened_at < self.reset_after:
+            raise CircuitOpen('{} failures in a row; not trying again for {:.0f}s'.format(
+                              self.failures, self.reset_after - (self.clock() - self.opened_at)))
+        # let this one through; if it fails too, open again
+        self.opened_at = None
+        self.failures = self.threshold - 1
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold and self.opened_at is None:
+            self.opened_at = self.clock()
+            self.trips += 1
+
+def retry(fetch, policy, breaker=None, record=None, retry_on=(Exception,), on_failure=None,
+          sleep=time.sleep):
+    '''fetch() until it returns, at most policy.attempts times; the last
+    error is raised. Each failure is counted in record (a run report stage)
+    as 'retries', and the time spent waiting as 'backoff_seconds', and
+    on_failure(err) is called if given.'''
+    for attempt in range(1, policy.attempts + 1):
+        if breaker is not None:
+            breaker.check()
+        try:
+            result = fetch()
+        except retry_on as err:
+            if breaker is not None:
+                breaker.failure()
+            if record is not None:
+                record['retries'] = record.get('retries', 0) + 1
+            if on_failure is not None:
+                on_failure(err)
+            if attempt == policy.attempts:
+                raise
+            delay = policy.delay(attempt)
+            if record is not None:
+                record['backoff_seconds'] = record.get('backoff_seconds', 0) + delay
+            sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.success()
+        return result
+
+_sessions = {}
+
+def new_session(pool_size=1):
+    '''A requests session that keeps its connections alive; requests asks
+    for gzip (and brotli, if installed) responses by default.'''
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def session(name):
+    '''This process's shared session for name, made on first use.'''
+    if name not in _sessions:
+        _sessions[name] = new_session()
+    return _sessions[name]
+
+def close_sessions():
+    for name in list(_sessions):
+        _sessions.pop(name).close()
@@ -0,0 +1,185 @@
+'''Dictionary-encoded, columnar ("packed") JSON for the front-end, and the
+precompressed copies and manifest published next to the output.
+
+A packed file is {"format": FORMAT, "strings": [...], "shapes": [...],
+"columns": [...], "data": value}. Every string, key or value, is stored
+once in strings, and every distinct list of object keys once in shapes
+(as string indexes). The values of all objects with the same keys are
+stored by column: columns[k][i] holds the i-th key's value for each
+object of shape k, in the order the objects come in. In a value:
+
+  - an integer is an index into strings,
+  - a string is a number, written as JSON,
+  - [k] with k >= 0 is the next object of shape k, and
+  - [-1, v1, v2, ...] is a list,
+
+and true, false and null stand for themselves. Strings are numbered by
+how often they occur, so campus codes, dates and instructor names take a
+digit or two, and keeping each field's values together lets gzip and
+brotli find the repeats.
+
+scheduler.js has the matching unpackData().'''
+
+import collections
+import gzip
+import hashlib
+import json
+import os
+
+import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FORMAT = 'packed-1'
+LIST = -1
+MANIFEST_NAME = 'manifest.json'
+
+def plain(value, default):
+    if isinstance(value, (dict, list, tuple, str, int, float, bool)) or value is None:
+        return value
+    return default(value)
+
+def json_key(key):
+    # the same conversion json.dumps makes for non-string keys
+    return key if isinstance(key, str) else json.dumps(key)
+
+def pack(data, default=None):
+    '''The packed form of data; default is called on values json can't
+    encode, as with json.dumps.'''
+    string_counts = collections.Counter()
+
+    def count(value):
+        value = plain(value, default)
+        if isinstance(value, str):
+            string_counts[value] += 1
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                string_counts[json_key(key)] += 1
+                count(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                count(item)
+
+    count(data)
+    # most_common keeps first-seen order among ties, so output is stable
+    strings = {string: i for i, (string, _) in enumerate(string_counts.most_common())}
+    shapes = {}
+    columns = []
+
+    def encode(value):
+        value = plain(value, default)
+        if isinstance(value, str):
+            return strings[value]
+        elif isinstance(value, bool) or value is None:
+            return value
+        elif isinstance(value, (int, float)):
+            return json.dumps(value)
+        elif isinstance(value, dict):
+            keys = tuple(json_key(key) for key in value)
+            if keys not in shapes:
+                shapes[keys] = len(shapes)
+                columns.append([[] for _ in keys])
+            shape = shapes[keys]
+            # take this object's row before encoding the objects inside it,
+            # which is the order unpack() reads them back in
+            row = len(columns[shape][0]) if keys else 0
+            for column in columns[shape]:
+                column.append(None)
+            for column, item in zip(columns[shape], value.values()):
+                column[row] = encode(item)
+            return [shape]
+        else:
+            encoded = [LIST]
+            encoded.extend(encode(item) for item in value)
+            return encoded
+
+    encoded = encode(data)
+    return collections.OrderedDict([
+        ('format', FORMAT),
+        ('strings', list(strings)),
+        ('shapes', [[strings[key] for key in keys] for keys in shapes]),
+        ('columns', columns),
+        ('data', encoded)])
+
+def dumps(data, default=None):
+    return json.dumps(pack(data, default), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def unpack(packed):
+    '''Inverse of pack().'''
+    if packed.get('format') != FORMAT:
+        raise ValueError('not a {} file'.format(FORMAT))
+    strings = packed['strings']
+    shapes = [[strings[key] for key in shape] for shape in packed['shapes']]
+    columns = packed['columns']
+    rows = [0] * len(shapes)
+
+    def decode(value):
+        if isinstance(value, bool) or value is None:
+            return value
+        elif isinstance(value, int):
+            return strings[value]
+        elif isinstance(value, str):
+            return json.loads(value)
+        elif value[0] == LIST:
+            return [decode(item) for item in value[1:]]
+        else:
+            shape = value[0]
+            row = rows[shape]
+            rows[shape] += 1
+            return {key: decode(column[row]) for key, column in zip(shapes[shape], columns[shape])}
+
+    return decode(packed['data'])
+
+def compressed_variants(data):
+    '''(suffix, bytes) for each precompressed copy of data worth publishing;
+    .br only if the brotli module is installed.'''
+    # mtime=0 so the same data always compresses to the same bytes
+    variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    return variants
+
+class Output:
+    '''Writes published files (atomically, skipping unchanged ones), with
+    precompressed .gz/.br copies next to them if compress is set, and
+    remembers the hash and sizes of each for the manifest.'''
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.entries = {}
+
+    def write(self, path, data):
+        '''Returns whether the file itself changed.'''
+        changed = cache.write_if_changed(path, data)
+        entry = collections.OrderedDict([('bytes', len(data)), ('sha256', hashlib.sha256(data).hexdigest())])
+        if self.compress:
+            suffixes = ['.gz'] + (['.br'] if brotli is not None else [])
+            # a copy older than the file is left from before it changed
+            if changed or not all(os.path.exists(path + suffix) and
+                                  os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+                                  for suffix in suffixes):
+                for suffix, compressed in compressed_variants(data):
+                    cache.write_if_changed(path + suffix, compressed)
+            for suffix in suffixes:
+                entry[suffix[1:] + '_bytes'] = os.path.getsize(path + suffix)
+        self.entries[path] = entry
+        return changed
+
+    def write_manifest(self, directory):
+        '''Adds what was written to directory since the last call to its
+        manifest, keeping entries for files earlier runs wrote that are
+        still there.'''
+        path = os.path.join(directory, MANIFEST_NAME)
+        try:
+            with open(path) as f:
+                files = json.load(f, object_pairs_hook=collections.OrderedDict)['files']
+        except (OSError, ValueError, KeyError):
+            files = {}
+        for file_path in list(self.entries):
+            if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(directory):
+                files[os.path.basename(file_path)] = self.entries.pop(file_path)
+        files = collections.OrderedDict((name, files[name]) for name in sorted(files)
+                                        if os.path.exists(os.path.join(directory, name)))
+        cache.write_if_changed(path, json.dumps({'files': files}, indent=1).encode('utf-8'))
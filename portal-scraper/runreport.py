@@ -0,0 +1,140 @@
+'''Timings and counters for each stage of a scrape, collected into a JSON
+run report.
+
+Each stage is one dict (stage name, labels such as term and area, counts
+such as bytes and rows, and its duration), so leaving this on costs a
+couple of clock reads and an append per stage. Stages named in
+profile_stages are also run under cProfile.
+
+A stage held open in a generator would also time (and profile) whatever
+its consumer does between items, so it yields each item under paused(),
+and a consumer in a stage of its own gets items through
+iterate_paused().
+
+Warnings go through warn(), which counts them; workers send their counts
+back with drain_warnings().'''
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import sys
+import time
+
+COUNTERS = ('bytes', 'rows', 'retries', 'backoff_seconds')
+_END = object()
+
+class RunReport:
+    def __init__(self):
+        self.records = []
+        self.started = time.time()
+        self.profile_stages = set()
+        self.profile_dir = '.'
+        self.profiles = {}
+        self.profiling = False
+        # id of each running stage's record -> its profile and time paused
+        self.running = {}
+        self.warnings = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        '''Times the with-block as one run of the named stage; the dict it
+        yields can be given counters and labels along the way.'''
+        record = {'stage': name}
+        record.update(fields)
+        profile = None
+        if name in self.profile_stages and not self.profiling:
+            # cProfile can only profile one thing at a time per thread
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            self.profiling = True
+            profile.enable()
+        state = self.running[id(record)] = {'profile': profile, 'paused': 0.0}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start - state['paused']
+            del self.running[id(record)]
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def paused(self, record):
+        '''Leaves the with-block out of the time and profile of the running
+        stage whose record this is.'''
+        state = self.running[id(record)]
+        profile = state['profile']
+        if profile is not None:
+            profile.disable()
+            self.profiling = False
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            state['paused'] += time.perf_counter() - start
+            if profile is not None:
+                profile.enable()
+                self.profiling = True
+
+    def iterate_paused(self, record, items):
+        '''Yields items, leaving the time taken to produce each out of the
+        stage whose record this is.'''
+        items = iter(items)
+        while True:
+            with self.paused(record):
+                item = next(items, _END)
+            if item is _END:
+                return
+            yield item
+
+    def warn(self, message):
+        '''Prints a warning to stderr and counts it.'''
+        print(message, file=sys.stderr)
+        self.warnings += 1
+
+    def drain(self):
+        '''Returns and forgets the records so far, for sending back from a
+        worker process.'''
+        records, self.records = self.records, []
+        return records
+
+    def drain_warnings(self):
+        '''Returns and resets the number of warnings so far.'''
+        warnings, self.warnings = self.warnings, 0
+        return warnings
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def totals(self):
+        totals = collections.OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            for counter in COUNTERS:
+                if counter in record:
+                    total[counter] = total.get(counter, 0) + record[counter]
+        return totals
+
+    def write(self, path, **extra):
+        report = collections.OrderedDict()
+        report['started'] = datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat()
+        report['seconds'] = time.time() - self.started
+        report['totals'] = self.totals()
+        report['warnings'] = self.warnings
+        report.update(extra)
+        report['stages'] = self.records
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    def dump_profiles(self):
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.profile_dir, 'profile-{}-{}.prof'.format(name, os.getpid())))
@@ -1,43 +1,85 @@
 #!/usr/bin/env python3
 
-from splinter import Browser
-from bs4 import BeautifulSoup
 import json
 import re
 import sys
 import os
 import datetime
+import functools
+import gc
 import hashlib
-import http.client
 import hmac
 import base64
 import urllib.parse
-from multiprocessing import Pool, Lock
 import argparse
-import requests
 import collections
-import subprocess
+import io
+import heapq
+import itertools
+import queue
+import codecs
+import shlex
+import runreport
+import archive
+import cache
+import delta
+import fetching
+import packed
+import searchindex
+import time
+import signal
+
+# splinter, BeautifulSoup, lxml, requests and multiprocessing are slow to
+# import, so each is imported by the functions that use it
 
 MAX_PORTAL_CHROME_RETRIES = 5
 MAX_PORTAL_FIREFOX_RETRIES = 2
+MAX_PORTAL_HTTP_RETRIES = 2
+MAX_BROWSER_USES = 50
+PORTAL_POOL_SIZE = 10
+# the memo tables below are cleared when they get this big, so that a
+# daemon's don't grow without bound
+MAX_MEMO_ENTRIES = 100000
+# after the n-th failure in a row, a fetch waits up to base * 2**(n-1)
+# seconds (at most the max) before trying again; see fetching.py
+PORTAL_BACKOFF_BASE = 2
+PORTAL_BACKOFF_MAX = 60
+# once this many portal fetches in a row have failed, the portal is taken
+# to be down and fetches fail at once until the reset interval has passed
+PORTAL_BREAKER_FAILURES = 12
+PORTAL_BREAKER_RESET = 5 * 60
+# (connect, read) seconds for portal requests; a browser gets the longer
+# page load timeout
+PORTAL_TIMEOUT = (10, 60)
+PORTAL_PAGE_LOAD_TIMEOUT = 120
 
 ENDPOINT = 'www.lingkapis.com'
 SERVICE = '/v1/harveymudd/coursecatalog/ps/datasets/coursecatalog'
 QUERYSTRING = '?limit=1000000000'
-MAX_RETRIES = 15
+MAX_RETRIES = 8
+API_BACKOFF_BASE = 1
+API_BACKOFF_MAX = 60
+API_TIMEOUT = (10, 60)
+API_CHUNK_SIZE = 1 << 16
+API_BASE_URL = 'https://' + ENDPOINT
 
-if 'KEY' in os.environ and 'SECRET' in os.environ:
-    KEY = os.environ['KEY']
-    SECRET = bytes(os.environ['SECRET'], 'ascii')
-else:
-    try:
-        mydir = os.path.dirname(os.path.abspath(__file__))
-        KEY = subprocess.check_output(['bash', '-c', 'source .env && printf %s "$KEY"'], cwd=mydir).decode('ascii')
-        SECRET = subprocess.check_output(['bash', '-c', 'source .env && printf %s "$SECRET"'], cwd=mydir)
-    except:
-        print('KEY and SECRET not provided; API not available', file=sys.stderr)
-        KEY = ''
-        SECRET = b''
+PORTAL_URL = 'https://portal.hmc.edu/ICS/default.aspx?portlet=Course_Schedules&screen=Advanced+Course+Search'
+
+# the API key id and secret, read on first use by api_credentials()
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+_credentials = None
+
+# stage timings for this process; pool workers send theirs back with each result
+REPORT = runreport.RunReport()
+# parsed and merged term data from earlier runs, by this file's code
+CACHE = cache.ContentCache(code_path=os.path.abspath(__file__))
+# what --record stores each fetch in, or --replay reads it from
+ARCHIVE = archive.FetchArchive()
+# everything published goes through here; --packed turns on the
+# precompressed copies
+OUTPUT = packed.Output()
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+REPORT_STAGES = ['api_fetch', 'api_format', 'portal_fetch', 'parse', 'merge', 'index', 'history', 'delta', 'write']
 
 TERM_RE = re.compile(r'(?P<season>[A-Z]{2}) (?P<part>(?:[A-Z0-9]{2})?) (?P<year>[0-9]{4})')
 def term_sort(term):
@@ -48,6 +90,7 @@ def term_sort(term):
         return (0, 0, '')
 
 def main():
+    global API_BASE_URL
     parser = argparse.ArgumentParser()
     parser.add_argument('--directory', '-d', default='.', action='store')
     which_data = parser.add_mutually_exclusive_group()
@@ -55,11 +98,196 @@ def main():
     which_data.add_argument('--api-classes', '-p', action='store_true')
     parser.add_argument('--no-save', '-e', '--dry-run', action='store_true')
     parser.add_argument('--fetch-infomap', '-i', action='store_true')
+    parser.add_argument('--max-browser-uses', type=int, default=MAX_BROWSER_USES, action='store')
+    parser.add_argument('--fetch-engine', choices=['browser', 'http'], default='browser', action='store')
+    parser.add_argument('--portal-url', default=PORTAL_URL, action='store')
+    parser.add_argument('--api-url', default=API_BASE_URL, action='store')
+    parser.add_argument('--max-sessions', type=int, default=PORTAL_POOL_SIZE, action='store')
+    parser.add_argument('--slot-masks', action='store_true',
+                        help='add each section\'s weekly time-slot bitmasks to the term data (see timeslots.py)')
+    parser.add_argument('--report', action='store', help='write a JSON run report here')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, action='store')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--enrollment-only', action='store_true',
+                        help='only refresh enrollment figures of already published terms')
+    parser.add_argument('--packed', action='store_true',
+                        help='also write dictionary-encoded .packed.json files, gzip/brotli copies and a manifest')
+    parser.add_argument('--shards', action='store_true',
+                        help='also write each term split by department and campus, for lazy loading')
+    parser.add_argument('--search-index', action='store_true',
+                        help='also write a search index for each term (see searchindex.py)')
+    parser.add_argument('--deltas', action='store_true',
+                        help='also write what changed in each term since its last version (see delta.py)')
+    parser.add_argument('--history', action='store',
+                        help='add each term\'s enrollment figures to the history kept in this directory '
+                             '(see enrollhistory.py)')
+    stage = parser.add_mutually_exclusive_group()
+    stage.add_argument('--api-only', action='store_true',
+                       help='only fetch the API and write its terms; needs no browser (no main.json)')
+    stage.add_argument('--portal-only', action='store_true',
+                       help='scrape the portal without merging in API data')
+    stage.add_argument('--parse-html', nargs='+', metavar='PAGE', action='store',
+                       help='parse saved portal result pages instead of scraping; each is written '
+                            'as a term named after the file (e.g. "FA  2024.html")')
+    archive_mode = parser.add_mutually_exclusive_group()
+    archive_mode.add_argument('--record', metavar='ARCHIVE', action='store',
+                              help='also store everything fetched in this archive, as a new snapshot '
+                                   '(see archive.py)')
+    archive_mode.add_argument('--replay', metavar='ARCHIVE', action='store',
+                              help='read everything from a snapshot in this archive instead of fetching it; '
+                                   'the cache is not used, so parsing changes show')
+    parser.add_argument('--snapshot', action='store',
+                        help='name of the snapshot to record (default: the time) or replay (default: the latest)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, refreshing each term on its own interval')
+    parser.add_argument('--refresh-selected', type=int, default=REFRESH_INTERVALS['selected'], action='store',
+                        help='seconds between refreshes of the selected term (daemon)')
+    parser.add_argument('--refresh-future', type=int, default=REFRESH_INTERVALS['future'], action='store',
+                        help='seconds between refreshes of later terms, the API and the term list (daemon)')
+    parser.add_argument('--refresh-past', type=int, default=REFRESH_INTERVALS['past'], action='store',
+                        help='seconds between refreshes of earlier terms (daemon)')
+    parser.add_argument('--status-file', action='store',
+                        help='where the daemon writes its status (default: status.json in the directory)')
+    parser.add_argument('--profile', choices=REPORT_STAGES, default=[], action='append',
+                        help='run this stage under cProfile (may be repeated)')
     args = parser.parse_args()
-    api_data = fetch_api_data()['data']
-    api_classes_by_term = format_api_data_as_portal_data(api_data)
+    if args.daemon and (args.record or args.replay):
+        parser.error('--record and --replay are for single runs, not --daemon')
+    if args.slot_masks:
+        # needs numpy, so only imported when asked for
+        global timeslots
+        import timeslots
+    if args.history:
+        # also needs numpy
+        global enrollhistory
+        import enrollhistory
+    profile_dir = os.path.dirname(os.path.abspath(args.report or 'report.json'))
+    API_BASE_URL = args.api_url
+    # parsed data is cached by page, so a replay would never reparse
+    cache_dir = None if args.no_cache or args.replay else args.cache_dir
+    if args.record:
+        archive_args = (args.record, args.snapshot or archive.snapshot_name(), 'record')
+    else:
+        archive_args = (args.replay, args.snapshot, 'replay')
+    init_portal_worker_process(args.max_browser_uses, args.fetch_engine, args.portal_url,
+                               args.profile, profile_dir, cache_dir, archive_args)
+    OUTPUT.compress = args.packed
+    if args.enrollment_only:
+        refresh_enrollment(args)
+        finish_recording()
+        if args.report:
+            REPORT.write(args.report)
+        return
+    if not args.no_save:
+        os.makedirs(args.directory, exist_ok=True)
+    if args.api_only or args.parse_html:
+        if args.api_only:
+            publish_api_only(args)
+        else:
+            publish_saved_html(args)
+        finish_recording()
+        if args.report:
+            REPORT.write(args.report)
+        return
+    if args.daemon:
+        browser_pool = BrowserPool(processes=args.max_sessions, max_uses=args.max_browser_uses,
+                                   fetch_engine=args.fetch_engine, profile_stages=args.profile,
+                                   profile_dir=profile_dir, cache_dir=cache_dir)
+        # let `kill` shut the browsers down the same way ^C does
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            run_daemon(args, browser_pool)
+        finally:
+            # jobs in flight are abandoned, not waited for
+            browser_pool.terminate()
+        return
+    api_classes_by_term = fetch_api_classes(args)
     selected_term, all_terms, courseareas = fetch_portal_info()
     all_terms.sort(key=term_sort)
+    terms_to_fetch, api_extra_terms = choose_terms(args, selected_term, all_terms, api_classes_by_term)
+    # a replay only parses, which needs no more processes than CPUs
+    browser_pool = BrowserPool(processes=(os.cpu_count() or 1) if ARCHIVE.replaying else args.max_sessions,
+                               max_uses=args.max_browser_uses, fetch_engine=args.fetch_engine,
+                               profile_stages=args.profile, profile_dir=profile_dir, cache_dir=cache_dir)
+    # one queue for every term and course area fetch
+    scheduler = PortalScheduler(browser_pool, max_in_flight=args.max_sessions)
+    publisher = TermPublisher(args, courseareas)
+    submit_term_jobs(scheduler, publisher, terms_to_fetch, selected_term, api_classes_by_term)
+    # merge and write each term as soon as its portal data is in, while
+    # other fetches are still running
+    try:
+        for func, arg, result in scheduler.run():
+            if func is fetch_and_parse_portal_term_cached:
+                publisher.term_done(*result, api_classes_by_term.pop(result[0], None))
+            else:
+                publisher.area_done(arg[0], *result)
+    except BaseException:
+        # ^C only reaches this process; see init_pool_worker_process
+        browser_pool.terminate()
+        raise
+    classes_by_term = publisher.classes_by_term
+    for term in api_classes_by_term:
+        if term not in classes_by_term:
+            classes_by_term[term] = compact_term(api_classes_by_term[term])
+    api_classes_by_term = None
+    browser_pool.close()
+    browser_pool.report()
+    scheduler.report()
+    report_retries()
+    finish_recording()
+    if not args.no_save:
+        write_main(args, selected_term, all_terms, api_extra_terms, courseareas, classes_by_term)
+        for term in api_extra_terms:
+            write_term(args, term, classes_by_term[term])
+            if args.search_index:
+                write_search_index(args, term, classes_by_term[term])
+        write_manifest(args)
+    CACHE.prune()
+    if args.report:
+        REPORT.write(args.report, workers=browser_pool.worker_stats,
+                     cache={'hits': CACHE.hits, 'misses': CACHE.misses},
+                     scheduler={'jobs': scheduler.completed, 'jobs_per_second': scheduler.throughput()})
+
+def finish_recording(file=sys.stderr):
+    if ARCHIVE.recording:
+        fetches = ARCHIVE.finish()
+        print('recorded {} fetches as snapshot {} in {}'.format(fetches, ARCHIVE.snapshot, ARCHIVE.directory),
+              file=file)
+
+def fetch_api_classes(args):
+    '''The API's classes by term, in portal form; none with --portal-only.'''
+    if args.portal_only:
+        return {}
+    return format_api_data_as_portal_data(fetch_api_courses())
+
+def publish_api_only(args):
+    '''Writes each term the API has, as it comes from the API.'''
+    api_classes_by_term = fetch_api_classes(args)
+    for term in sorted(api_classes_by_term, key=term_sort):
+        print(term)
+        if not args.no_save:
+            write_term(args, term, api_classes_by_term[term])
+            if args.search_index:
+                write_search_index(args, term, api_classes_by_term[term])
+    write_manifest(args)
+
+def publish_saved_html(args):
+    '''Parses saved portal pages (the results of an all-courses search of
+    one term) and writes each as the term its file is named after.'''
+    for path in args.parse_html:
+        term = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as f:
+            classes = parse_portal_html_with_report(f.read(), term=term)
+        print(term)
+        if not args.no_save:
+            write_term(args, term, classes)
+            if args.search_index:
+                write_search_index(args, term, classes)
+    write_manifest(args)
+
+def choose_terms(args, selected_term, all_terms, api_classes_by_term):
+    '''The portal terms to scrape (all_terms must be sorted) and the terms
+    only the API knows about.'''
     api_extra_terms = sorted(api_classes_by_term.keys() - set(all_terms), key=term_sort)
     if args.all_terms:
         terms_to_fetch = all_terms
@@ -67,44 +295,523 @@ def main():
         terms_to_fetch = [term for term in all_terms if term in api_classes_by_term]
     else:
         terms_to_fetch = all_terms[:all_terms.index(selected_term)+1]
-    classes_by_term = fetch_some_portal_classes(terms_to_fetch)
-    merge(classes_by_term, api_classes_by_term)
+    return terms_to_fetch, api_extra_terms
+
+def submit_term_jobs(scheduler, publisher, terms, selected_term, api_classes_by_term):
+    # the selected term first, then the rest in order, each term's page
+    # before its areas
+    for i, term in enumerate(terms):
+        urgency = (term != selected_term, i)
+        scheduler.submit(urgency + (0,), fetch_and_parse_portal_term_cached, (term, api_term_hash(api_classes_by_term, term)))
+        if publisher.args.fetch_infomap:
+            publisher.expect_areas(term)
+            for coursearea in publisher.courseareas:
+                scheduler.submit(urgency + (1,), fetch_and_parse_portal_coursearea, (term, coursearea))
+
+class TermPublisher:
+    '''Merges, writes and keeps (in compact form) each term as its
+    PortalScheduler results come in, and writes a term's infomap once all
+    of its course areas are in or failed (a failed area keeps what the
+    last infomap had for it). With --search-index, a term's index is
+    written once both the term and its infomap (if fetched) are in.'''
+    def __init__(self, args, courseareas):
+        self.args = args
+        self.courseareas = courseareas
+        self.classes_by_term = {}
+        self.infomaps = {}
+        self.areas_left = {}
+        # the last complete infomap of each term, for its index
+        self.finished_infomaps = {}
+        self.index_waiting = set()
+
+    def term_done(self, term, merged_key, classes, api_classes):
+        print(term)
+        cached = CACHE.load(merged_key) if classes is None else None
+        if cached is not None:
+            # same portal page and API data as a previous run
+            classes = cached
+        else:
+            if classes is None:
+                # the cached merge went bad since the worker looked for it
+                classes = fetch_and_parse_portal_term(term)[1]
+            if api_classes is not None:
+                with REPORT.stage('merge', term=term):
+                    merge(classes, api_classes, [term])
+            CACHE.store(merged_key, classes)
+        if not self.args.no_save:
+            write_term(self.args, term, classes)
+        # keep finished terms in compact form; with --all-terms there are many
+        self.classes_by_term[term] = compact_term(classes)
+        if self.args.search_index and not self.args.no_save:
+            if term in self.areas_left:
+                self.index_waiting.add(term)
+            else:
+                write_search_index(self.args, term, self.classes_by_term[term], self.finished_infomaps.get(term))
+
+    def expect_areas(self, term):
+        self.infomaps[term] = {}
+        self.areas_left[term] = len(self.courseareas)
+
+    def area_done(self, term, coursearea, courses):
+        self.infomaps[term][coursearea] = courses
+        print('.', end='', flush=True, file=sys.stderr)
+        self.area_counted(term)
+
+    def area_failed(self, term, coursearea):
+        previous = self.finished_infomaps.get(term, {})
+        if coursearea in previous:
+            self.infomaps[term][coursearea] = previous[coursearea]
+        self.area_counted(term)
+
+    def area_counted(self, term):
+        self.areas_left[term] -= 1
+        if self.areas_left[term] == 0 and not self.args.no_save:
+            # keep the areas in the portal's order
+            write_json(os.path.join(self.args.directory, term+'_infomap.json'),
+                       {coursearea: self.infomaps[term][coursearea] for coursearea in self.courseareas
+                        if coursearea in self.infomaps[term]})
+        if self.areas_left[term] == 0:
+            self.finished_infomaps[term] = self.infomaps.pop(term)
+            del self.areas_left[term]
+            if term in self.index_waiting:
+                self.index_waiting.discard(term)
+                write_search_index(self.args, term, self.classes_by_term[term], self.finished_infomaps[term])
+
+def write_main(args, selected_term, all_terms, api_extra_terms, courseareas, classes_by_term):
     if len(api_extra_terms) > 0 and (term_sort(api_extra_terms[0]) < term_sort(selected_term)):
         selected_term = api_extra_terms[0]
-    if args.fetch_infomap:
-        infomaps = {term: fetch_portal_areamap(term, courseareas) for term in terms_to_fetch}
-    if not args.no_save:
-        os.makedirs(args.directory, exist_ok=True)
-        with open(os.path.join(args.directory, 'main.json'), 'w') as f:
-            json.dump({'terms': sorted(all_terms + api_extra_terms, key=term_sort),
-                       'areas': courseareas,
-                       'selected': selected_term,
-                       'selected_data': classes_by_term[selected_term]},
-                      f, separators=(',',':'))
-        for term in terms_to_fetch + api_extra_terms:
-            with open(os.path.join(args.directory, term+'.json'), 'w') as f:
-                json.dump(classes_by_term[term], f, separators=(',',':'))
-            if args.fetch_infomap:
-                with open(os.path.join(args.directory, term+'_infomap.json'), 'w') as f:
-                    json.dump(infomaps[term], f, separators=(',',':'))
+    main_data = {'terms': sorted(all_terms + api_extra_terms, key=term_sort),
+                 'areas': courseareas,
+                 'selected': selected_term}
+    # the sharded front-end loads only the shards it needs of the selected
+    # term, not the whole of it
+    if not args.shards:
+        main_data['selected_data'] = classes_by_term[selected_term]
+        if args.slot_masks:
+            main_data['selected_data'] = timeslots.with_slot_masks(main_data['selected_data'])
+    write_json(os.path.join(args.directory, 'main.json'), main_data)
+    if args.packed:
+        # the packed front-end fetches the selected term on its own, so the
+        # term list and areas aren't held up behind it
+        write_packed(os.path.join(args.directory, 'main.packed.json'),
+                     {'terms': sorted(all_terms + api_extra_terms, key=term_sort),
+                      'areas': courseareas,
+                      'selected': selected_term})
 
-def format_api_data_as_portal_data(api_data):
-    api_classes = {api_class['courseNumber']: api_class for api_class in api_data if 'courseNumber' in api_class}
+REFRESH_INTERVALS = {'selected': 5 * 60, 'future': 30 * 60, 'past': 24 * 60 * 60}
+REFRESH_ORDER = ['selected', 'future', 'past']
+# a failed refresh is tried again after at most this long
+RETRY_INTERVAL = 5 * 60
+# how often an idle daemon rewrites its status file
+STATUS_INTERVAL = 60
+
+def term_category(term, selected_term):
+    if term == selected_term:
+        return 'selected'
+    return 'future' if term_sort(term) < term_sort(selected_term) else 'past'
+
+def timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+def run_daemon(args, browser_pool):
+    '''Scrapes forever on one warm browser pool, keeping every term's data in
+    memory. Each term is refreshed on the interval for its category
+    (selected, future or past term); the API data and the portal's term
+    list are refreshed on the future interval. Terms are published as
+    they finish, and status.json records when each was last refreshed.'''
+    intervals = {'selected': args.refresh_selected, 'future': args.refresh_future, 'past': args.refresh_past}
+    status_path = args.status_file or (None if args.no_save else os.path.join(args.directory, 'status.json'))
+    publisher = None
     api_classes_by_term = {}
-    for api_class in api_data:
-        merge(api_classes_by_term, api_class_to_portal_classes(api_class))
-    # return classes in sorted order
-    for term in api_classes_by_term:
-        api_classes_by_term[term] = collections.OrderedDict(sorted(api_classes_by_term[term].items()))
+    selected_term = all_terms = courseareas = None
+    terms_to_fetch, api_extra_terms = [], []
+    sources = {name: {'last_refresh': None, 'next_refresh': 0, 'error': None} for name in ('api', 'portal_info')}
+    terms = {}
+
+    def refreshed(entry, interval, now, err=None):
+        if err is None:
+            entry['last_refresh'] = now
+            entry['next_refresh'] = now + interval
+            entry['error'] = None
+        else:
+            print('\n{}'.format(err), file=sys.stderr)
+            entry['next_refresh'] = now + min(interval, RETRY_INTERVAL)
+            entry['error'] = str(err)
+
+    def write_status():
+        if status_path is None:
+            return
+        now = time.time()
+        status = collections.OrderedDict()
+        status['updated'] = timestamp(now)
+        status['selected'] = selected_term
+        for name, entry in sources.items():
+            status[name] = {'last_refresh': timestamp(entry['last_refresh']),
+                            'next_refresh': timestamp(entry['next_refresh']),
+                            'error': entry['error']}
+        status['terms'] = collections.OrderedDict()
+        for term in sorted(terms, key=term_sort):
+            entry = terms[term]
+            status['terms'][term] = {
+                'category': entry['category'],
+                'last_refresh': timestamp(entry['last_refresh']),
+                # seconds since the published data was scraped
+                'lag': None if entry['last_refresh'] is None else round(now - entry['last_refresh']),
+                'next_refresh': timestamp(entry['next_refresh']),
+                'error': entry['error']}
+        cache.atomic_write(status_path, json.dumps(status, indent=1).encode('utf-8'))
+
+    def on_error(func, arg, err):
+        term = arg[0]
+        if term in terms:
+            refreshed(terms[term], intervals[terms[term]['category']], time.time(), err)
+        if func is fetch_and_parse_portal_coursearea:
+            # so the term's infomap and index still get written
+            publisher.area_failed(term, arg[1])
+
+    while True:
+        REPORT.started = time.time()
+        now = time.time()
+        if sources['api']['next_refresh'] <= now:
+            try:
+                api_classes_by_term = fetch_api_classes(args)
+            except Exception as err:
+                refreshed(sources['api'], intervals['future'], now, err)
+            else:
+                refreshed(sources['api'], intervals['future'], now)
+                if publisher is not None:
+                    for term in api_extra_terms:
+                        publisher.classes_by_term.pop(term, None)
+        if sources['portal_info']['next_refresh'] <= now:
+            try:
+                selected_term, all_terms, courseareas = fetch_portal_info()
+            except Exception as err:
+                refreshed(sources['portal_info'], intervals['future'], now, err)
+            else:
+                refreshed(sources['portal_info'], intervals['future'], now)
+                all_terms.sort(key=term_sort)
+                if publisher is None:
+                    publisher = TermPublisher(args, courseareas)
+                publisher.courseareas = courseareas
+                CACHE.prune()
+        if publisher is not None and sources['api']['last_refresh'] is not None:
+            terms_to_fetch, api_extra_terms = choose_terms(args, selected_term, all_terms, api_classes_by_term)
+            for term in list(terms):
+                if term not in terms_to_fetch:
+                    del terms[term]
+                    publisher.classes_by_term.pop(term, None)
+            for term in terms_to_fetch:
+                entry = terms.setdefault(term, {'last_refresh': None, 'next_refresh': now, 'error': None})
+                entry['category'] = term_category(term, selected_term)
+            for term in api_extra_terms:
+                if term not in publisher.classes_by_term:
+                    publisher.classes_by_term[term] = compact_term(api_classes_by_term[term])
+                    if not args.no_save:
+                        write_term(args, term, publisher.classes_by_term[term])
+                        if args.search_index:
+                            write_search_index(args, term, publisher.classes_by_term[term])
+            due = sorted((term for term in terms_to_fetch if terms[term]['next_refresh'] <= now),
+                         key=lambda term: (REFRESH_ORDER.index(terms[term]['category']), term_sort(term)))
+            scheduler = PortalScheduler(browser_pool, max_in_flight=args.max_sessions)
+            submit_term_jobs(scheduler, publisher, due, selected_term, api_classes_by_term)
+            for func, arg, result in scheduler.run(on_error=on_error):
+                if func is fetch_and_parse_portal_term_cached:
+                    term = result[0]
+                    publisher.term_done(*result, api_classes_by_term.get(term))
+                    refreshed(terms[term], intervals[terms[term]['category']], time.time())
+                    if term == selected_term and not args.no_save:
+                        # publish the selected term right away rather than
+                        # after the rest of the cycle
+                        write_main(args, selected_term, all_terms, api_extra_terms, courseareas,
+                                   publisher.classes_by_term)
+                    write_manifest(args)
+                    write_status()
+                else:
+                    publisher.area_done(arg[0], *result)
+            if due and not args.no_save and selected_term in publisher.classes_by_term:
+                write_main(args, selected_term, all_terms, api_extra_terms, courseareas, publisher.classes_by_term)
+            if due:
+                write_manifest(args)
+                scheduler.report()
+        if args.report:
+            REPORT.write(args.report, workers=browser_pool.worker_stats,
+                         cache={'hits': CACHE.hits, 'misses': CACHE.misses})
+        # a daemon can't keep every stage record it ever made
+        REPORT.drain()
+        REPORT.drain_warnings()
+        # sleep until something is due, keeping the status file fresh
+        next_refresh = min([entry['next_refresh'] for entry in terms.values()] +
+                           [entry['next_refresh'] for entry in sources.values()])
+        while True:
+            write_status()
+            wait = next_refresh - time.time()
+            if wait <= 0:
+                break
+            time.sleep(min(wait, STATUS_INTERVAL))
+
+def write_term(args, term, classes):
+    if args.slot_masks:
+        classes = timeslots.with_slot_masks(classes)
+    path = os.path.join(args.directory, term+'.json')
+    previous = None
+    if args.deltas and os.path.exists(path):
+        with open(path, 'rb') as f:
+            previous = f.read()
+    write_json(path, classes)
+    if previous is not None:
+        write_delta(args, term, previous)
+    if args.packed:
+        write_packed(os.path.join(args.directory, term+'.packed.json'), classes)
+    if args.shards:
+        write_shards(args, term, classes)
+    table = enrollment_table(classes)
+    write_json(os.path.join(args.directory, term+'_enrollment.json'), table)
+    if args.history:
+        record_enrollment_history(args, term, table)
+
+def course_dept_campus(course_id):
+    '''The dept and campus parse_section_id would find in the course's
+    sections' ids, or (None, campus) for ids it can only guess a campus for.'''
+    id_match = CLASS_ID_RE.match(course_id)
+    if id_match:
+        return id_match.group('dept').strip(), id_match.group('campus')
+    id_match = re.match(SIMPLE_CLASS_ID_RE_STR, course_id, re.VERBOSE)
+    return None, id_match.group('campus') if id_match else None
+
+def shard_name(dept, campus):
+    return '-'.join(re.sub(r'[^A-Za-z0-9]+', '_', part or 'other') for part in (dept, campus))
+
+def write_shards(args, term, classes):
+    '''Writes the term split by department and campus, one
+    <term>_shard_<dept>-<campus>.json per pair, and <term>_shards.json
+    listing the shards and which shard each course (in term order) is in.'''
+    shards = {}
+    index = {'shards': collections.OrderedDict(), 'courses': collections.OrderedDict()}
+    for course_id, course in classes.items():
+        dept, campus = course_dept_campus(course_id)
+        name = shard_name(dept, campus)
+        index['courses'][course_id] = name
+        if name not in shards:
+            shards[name] = collections.OrderedDict()
+            index['shards'][name] = {'file': term+'_shard_'+name+'.json', 'dept': dept, 'campus': campus}
+        shards[name][course_id] = course
+    index['shards'] = collections.OrderedDict(sorted(index['shards'].items()))
+    for name, shard in index['shards'].items():
+        shard['courses'] = len(shards[name])
+        write_json(os.path.join(args.directory, shard['file']), shards[name])
+        if args.packed:
+            write_packed(os.path.join(args.directory, shard['file'][:-len('.json')]+'.packed.json'), shards[name])
+    # shards whose department or campus has gone from the term
+    prefix = term+'_shard_'
+    files = {shard['file'] for shard in index['shards'].values()}
+    for filename in os.listdir(args.directory):
+        if filename.startswith(prefix) and filename.split('.')[0]+'.json' not in files:
+            os.unlink(os.path.join(args.directory, filename))
+    write_json(os.path.join(args.directory, term+'_shards.json'), index)
+
+def write_search_index(args, term, classes, infomap=None):
+    with REPORT.stage('index', term=term) as record:
+        index = searchindex.build_index(classes, infomap)
+        record['rows'] = len(index['courses'])
+    write_json(os.path.join(args.directory, term+'_search.json'), index)
+
+# deltas kept for each term; a client further behind fetches the whole term
+DELTA_HISTORY = 12
+
+def write_delta(args, term, previous):
+    '''Writes the delta to the term's just written file from its previous
+    version (previous being its bytes), if it changed, and removes the
+    oldest deltas beyond DELTA_HISTORY.'''
+    with open(os.path.join(args.directory, term+'.json'), 'rb') as f:
+        current = f.read()
+    if current == previous:
+        return
+    with REPORT.stage('delta', term=term) as record:
+        old, new = json.loads(previous), json.loads(current)
+        changes = delta.diff_term(old, new)
+        order = delta.order(old, new)
+        record['rows'] = len(changes)
+        if not delta.same(delta.apply(old, changes, keys=order), new):
+            print('Error: delta for {} does not reproduce it; not writing it'.format(term), file=sys.stderr)
+            return
+    term_delta = {'from': delta.version(previous), 'to': delta.version(current), 'courses': changes}
+    if order is not None:
+        term_delta['order'] = order
+    write_json(os.path.join(args.directory, delta.file_name(term, delta.version(previous))), term_delta)
+    prefix = term+'_delta_'
+    deltas = sorted((os.path.join(args.directory, filename) for filename in os.listdir(args.directory)
+                     if filename.startswith(prefix) and filename.endswith('.json')),
+                    key=os.path.getmtime, reverse=True)
+    for path in deltas[DELTA_HISTORY:]:
+        # with the .gz and .br copies of --packed
+        for suffix in ('', '.gz', '.br'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+def write_manifest(args):
+    if (args.packed or args.shards or args.search_index or args.deltas) and not args.no_save:
+        OUTPUT.write_manifest(args.directory)
+
+ENROLLMENT_FIELDS = ['currentEnrollment', 'capacity', 'status']
+
+def enrollment_table(classes):
+    '''The fields that change during registration, small enough for the
+    front-end to poll: {course id: {section: [value per field]}}.'''
+    return {'fields': ENROLLMENT_FIELDS,
+            'courses': {course_id: {section: [section_data.get(field) for field in ENROLLMENT_FIELDS]
+                                    for section, section_data in course['sections'].items()}
+                        for course_id, course in classes.items()}}
+
+# each term's EnrollmentHistory, kept so the daemon only reads a term's
+# history once
+HISTORIES = {}
+
+def record_enrollment_history(args, term, table):
+    path = os.path.join(args.history, term)
+    if path not in HISTORIES:
+        HISTORIES[path] = enrollhistory.EnrollmentHistory(path)
+    with REPORT.stage('history', term=term) as record:
+        record['rows'] = HISTORIES[path].append(table, int(time.time()))
+
+def refresh_enrollment(args):
+    '''Patches new enrollment figures into the published selected term (or,
+    with --all-terms, the selected term and every later published one)
+    without a full scrape. As in a full scrape's merge, the figures come
+    from the term's portal page, and from the API only for sections the
+    portal doesn't list, so a section's enrollment and status never come
+    from different sources.'''
+    main_path = os.path.join(args.directory, 'main.json')
+    with open(main_path) as f:
+        main_data = json.load(f, object_pairs_hook=collections.OrderedDict)
+    selected_term = main_data['selected']
+    if args.all_terms:
+        # past terms' figures don't change any more
+        terms = [term for term in main_data['terms'] if term_sort(term) <= term_sort(selected_term)
+                 and os.path.exists(os.path.join(args.directory, term+'.json'))]
+    else:
+        terms = [selected_term]
+    classes_by_term = {}
+    figures = {}
+    missing = {}
+    for term in terms:
+        with open(os.path.join(args.directory, term+'.json')) as f:
+            classes = json.load(f, object_pairs_hook=collections.OrderedDict)
+        classes_by_term[term] = classes
+        figures[term] = {}
+        sections = [section_data for course in classes.values() for section_data in course['sections'].values()
+                    if 'section_id' in section_data]
+        # a term only the API knows about has no portal page (or statuses)
+        if any('status' in section_data for section_data in sections):
+            for section_data in iter_portal_sections(fetch_portal(term=term)):
+                figures[term][section_data['section_id']] = {field: section_data[field] for field in ENROLLMENT_FIELDS}
+        missing[term] = {section_data['section_id'] for section_data in sections} - figures[term].keys()
+    if (any(missing.values()) and
+            (ARCHIVE.has(archive.API_KEY) if ARCHIVE.replaying else api_credentials()[0])):
+        for course in fetch_api_courses():
+            for term, section_id, section_figures in api_course_enrollment(course):
+                if section_id in missing.get(term, ()):
+                    figures[term][section_id] = section_figures
+    for term in terms:
+        classes = classes_by_term[term]
+        for course in classes.values():
+            for section_data in course['sections'].values():
+                section_figures = figures[term].get(section_data.get('section_id'))
+                if section_figures is None:
+                    continue
+                # a section the portal no longer lists has no status
+                for field in ENROLLMENT_FIELDS:
+                    if field in section_figures:
+                        section_data[field] = section_figures[field]
+                    else:
+                        section_data.pop(field, None)
+        write_term(args, term, classes)
+        if term == selected_term and 'selected_data' in main_data:
+            main_data['selected_data'] = classes
+            write_json(main_path, main_data)
+        print(term)
+    write_manifest(args)
+
+def api_course_enrollment(course):
+    '''(portal term, section id, enrollment figures) for each section of a
+    course from the API.'''
+    for section in course.get('courseSections', ()):
+        section_figures = {field: section[field] for field in ENROLLMENT_FIELDS if field in section}
+        if not section_figures:
+            continue
+        for semester in section.get('calendarSessions', ()):
+            portal_terms = api_term_to_portal_terms(semester['externalId'])
+            if isinstance(portal_terms, str):
+                continue
+            section_id = section['externalId'][:-len(' '+semester['externalId'])]
+            for portal_term in portal_terms:
+                yield portal_term, section_id, section_figures
+
+def write_json(path, data):
+    '''Writes data as compact JSON, atomically, and only if it changed.'''
+    with REPORT.stage('write', file=os.path.basename(path)) as record:
+        data = json.dumps(data, separators=(',',':'), default=compact_to_json).encode('utf-8')
+        record['bytes'] = len(data)
+        if not OUTPUT.write(path, data):
+            record['unchanged'] = True
+
+def write_packed(path, data):
+    '''write_json in the packed format (see packed.py).'''
+    with REPORT.stage('write', file=os.path.basename(path)) as record:
+        data = packed.dumps(data, default=compact_to_json)
+        record['bytes'] = len(data)
+        if not OUTPUT.write(path, data):
+            record['unchanged'] = True
+
+def format_api_data_as_portal_data(api_data):
+    # api_data may be a generator (see fetch_api_courses); only walk it
+    # once, and leave the time it takes to produce each course out of here
+    with REPORT.stage('api_format') as record:
+        api_classes_by_term = {}
+        courses = 0
+        # everything made here lives on, and there are no cycles to find,
+        # but the collector would keep scanning it all as it grows
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for api_class in REPORT.iterate_paused(record, api_data):
+                for term, classes in api_class_to_portal_classes(api_class).items():
+                    term_classes = api_classes_by_term.setdefault(term, {})
+                    for course_id, class_data in classes.items():
+                        # a course only needs merging if an earlier API
+                        # course had the same id
+                        if course_id in term_classes:
+                            merge(term_classes[course_id], class_data, [term, course_id])
+                        else:
+                            term_classes[course_id] = class_data
+                courses += 1
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        # return classes in sorted order
+        for term in api_classes_by_term:
+            api_classes_by_term[term] = collections.OrderedDict(sorted(api_classes_by_term[term].items()))
+        record['rows'] = courses
     return api_classes_by_term
 
 API_TERM_RE = re.compile(r'^(?P<season>FA|SP|SU)(?P<year>[0-9]{4})(?P<part>[FP][12])?$')
+# there are only a few terms, but every section of every course names one
+_portal_terms = {}
+
 def api_term_to_portal_terms(api_term):
+    if api_term in _portal_terms:
+        return _portal_terms[api_term]
     m = API_TERM_RE.match(api_term)
     if not m:
-        print('bad api designator: {}'.format(api_term), file=sys.stderr)
+        REPORT.warn('bad api designator: {}'.format(api_term))
         return api_term
-    return {m.expand('\g<season> \g<part> \g<year>'), m.expand('\g<season>  \g<year>')}
+    if len(_portal_terms) >= MAX_MEMO_ENTRIES:
+        _portal_terms.clear()
+    # the same set object each time, so the terms always come out in the
+    # same order
+    _portal_terms[api_term] = {m.expand('\g<season> \g<part> \g<year>'), m.expand('\g<season>  \g<year>')}
+    return _portal_terms[api_term]
 
 def api_class_to_portal_classes(course):
     portal_data = {}
@@ -129,8 +836,8 @@ def api_class_to_portal_classes(course):
 
 def api_semester_session_to_portal_class(course, section, semester):
     if not section['externalId'].endswith(semester['externalId']):
-        print('invalid section id: {!r}; should end in {!r}'.format(
-              section['externalId'], semester['externalId'], file=sys.stderr))
+        REPORT.warn('invalid section id: {!r}; should end in {!r}'.format(
+                    section['externalId'], semester['externalId']))
     if not 'courseSectionSchedule' in section:
         # these sections should not be returned by the API anyways...
         #print('Warning: section missing schedule: {}'.format(section['externalId']), file=sys.stderr)
@@ -181,7 +888,7 @@ def api_instructor_names(api_instructors):
 
 def parse_api_schedule(schedule_part):
     if len(schedule_part['ClassEndingTime']) == 2:
-        print(schedule_part)
+        REPORT.warn('odd ending time: {}'.format(schedule_part))
     return {
         'days': schedule_part['ClassMeetingDays'].replace('-',''),
         'start_time': reformat_api_time(schedule_part['ClassBeginningTime']),
@@ -190,6 +897,8 @@ def parse_api_schedule(schedule_part):
         # what about the start and end dates?
     }
 
+# the same few dozen times come up for every section
+@functools.lru_cache(maxsize=None)
 def reformat_api_time(api_time):
     if api_time == '0':
         return None
@@ -213,50 +922,529 @@ def create_auth_header(keyId, secret, dateStr):
     encodedHMAC = urllib.parse.quote(create_signature(secret, signingStr))
     return 'Signature keyId="' + keyId + '",algorithm="hmac-sha1",headers="date (request-target)",signature="' + encodedHMAC + '"'
 
-def get_HTTP_response(endPoint, authorizationHeader, dateStr):
-    '''Connects to an endpoint via HTTPS and retrieves response'''
+def read_env_file(path):
+    '''The variables a shell-style .env file assigns (NAME=value, maybe
+    exported or quoted), read without running it; no $ expansion.'''
+    variables = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('export '):
+                line = line[len('export '):].lstrip()
+            name, sep, value = line.partition('=')
+            if sep and name.isidentifier():
+                variables[name] = ' '.join(shlex.split(strip_shell_comment(value)))
+    return variables
+
+def strip_shell_comment(text):
+    # as in the shell, # only starts a comment at the start of a word
+    quote = None
+    for i, c in enumerate(text):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '#' and (i == 0 or text[i-1].isspace()):
+            return text[:i]
+    return text
+
+def api_credentials():
+    '''(KEY, SECRET as bytes) from the environment, or else from .env next to
+    this file; empty if neither has them.'''
+    global _credentials
+    if _credentials is None:
+        if 'KEY' in os.environ and 'SECRET' in os.environ:
+            variables = os.environ
+        else:
+            try:
+                variables = read_env_file(ENV_FILE)
+            except (OSError, ValueError):
+                variables = {}
+        if 'KEY' not in variables or 'SECRET' not in variables:
+            print('KEY and SECRET not provided; API not available', file=sys.stderr)
+        _credentials = (variables.get('KEY', ''), bytes(variables.get('SECRET', ''), 'ascii'))
+    return _credentials
+
+def get_HTTP_response(baseUrl, authorizationHeader, dateStr, stream=False):
+    '''Requests the dataset over the shared keep-alive API session; raises
+    for an error status.'''
     headers = {'Date': dateStr, 'Authorization': authorizationHeader}
-    return requests.get('https://' + endPoint + SERVICE + QUERYSTRING, headers=headers)
+    res = fetching.session('api').get(baseUrl + SERVICE + QUERYSTRING, headers=headers, stream=stream,
+                                      timeout=API_TIMEOUT)
+    res.raise_for_status()
+    return res
+
+def api_retry_policy():
+    return fetching.RetryPolicy(MAX_RETRIES, API_BACKOFF_BASE, API_BACKOFF_MAX)
+
+def api_retry_errors():
+    '''What an API fetch is retried on: sometimes API auth is finicky, and
+    sometimes the connection fails or times out.'''
+    import requests
+    return (json.decoder.JSONDecodeError, requests.RequestException)
+
+def print_api_failure(err):
+    print('x', end='', flush=True, file=sys.stderr)
 
 def fetch_api_data():
-    json_err = None
-    for _ in range(MAX_RETRIES):
+    def fetch():
         dateStr = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S UTC')
+        authorizationHeader = create_auth_header(*api_credentials(), dateStr)
+        return get_HTTP_response(API_BASE_URL, authorizationHeader, dateStr).json()
+
+    try:
+        json_data = fetching.retry(fetch, api_retry_policy(), retry_on=api_retry_errors(),
+                                   on_failure=print_api_failure)
+    except json.decoder.JSONDecodeError as err:
+        print('\nError: not JSON', file=sys.stderr)
+        print(err.doc, file=sys.stderr)
+        raise
+    print('.', end='', flush=True, file=sys.stderr)
+    return json_data
 
-        authorizationHeader = create_auth_header(KEY, SECRET, dateStr)
-        res = get_HTTP_response(ENDPOINT, authorizationHeader, dateStr)
+def fetch_api_courses():
+    '''Like fetch_api_data()['data'], but parses the response as it comes
+    off the socket and yields one course at a time.'''
+    with REPORT.stage('api_fetch', retries=0, bytes=0) as record:
+        if ARCHIVE.replaying:
+            data = memoryview(ARCHIVE.get(archive.API_KEY))
+            chunks = (data[i:i + API_CHUNK_SIZE] for i in range(0, len(data), API_CHUNK_SIZE))
+            for course in iter_json_array_items(count_bytes(chunks, record), 'data'):
+                # what the consumer does with it isn't part of this stage
+                with REPORT.paused(record):
+                    yield course
+            return
+        # the response as received, for --record
+        raw = []
+
+        def fetch_first():
+            dateStr = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S UTC')
+            authorizationHeader = create_auth_header(*api_credentials(), dateStr)
+            res = get_HTTP_response(API_BASE_URL, authorizationHeader, dateStr, stream=True)
+            chunks = count_bytes(res.iter_content(API_CHUNK_SIZE), record)
+            if ARCHIVE.recording:
+                del raw[:]
+                chunks = keep_chunks(chunks, raw)
+            courses = iter_json_array_items(chunks, 'data')
+            try:
+                # a bad response fails before the first course; one that
+                # fails after it can't be retried, as courses are already out
+                return next(courses, None), courses
+            except BaseException:
+                res.close()
+                raise
 
         try:
-            json_data = res.json()
-            print('.', end='', flush=True, file=sys.stderr)
-            return json_data
-        except json.decoder.JSONDecodeError as e:
-            # sometimes API auth is finicky; try again.
-            json_err = e
-            print('x', end='', flush=True, file=sys.stderr)
-            continue
-    print('\nError: not JSON', file=sys.stderr)
-    print(res.content, file=sys.stderr)
-    raise json_err
+            first, courses = fetching.retry(fetch_first, api_retry_policy(), record=record,
+                                            retry_on=api_retry_errors(), on_failure=print_api_failure)
+        except json.decoder.JSONDecodeError as err:
+            print('\nError: not JSON', file=sys.stderr)
+            print(err.doc, file=sys.stderr)
+            raise
+        print('.', end='', flush=True, file=sys.stderr)
+        if first is not None:
+            for course in itertools.chain([first], courses):
+                with REPORT.paused(record):
+                    yield course
+        ARCHIVE.record(archive.API_KEY, b''.join(raw))
 
-def fetch_portal(term=None, coursearea=None):
-    for i in range(MAX_PORTAL_CHROME_RETRIES):
+def count_bytes(chunks, record):
+    for chunk in chunks:
+        record['bytes'] += len(chunk)
+        yield chunk
+
+def keep_chunks(chunks, kept):
+    for chunk in chunks:
+        kept.append(chunk)
+        yield chunk
+
+class JSONStreamReader:
+    '''Just enough of an incremental JSON tokenizer to walk the outer
+    structure of a document, decoding inner values whole.'''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        if self.pos > API_CHUNK_SIZE and self.pos * 2 > len(self.buf):
+            # drop what has been consumed, so the buffer stays small
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += self.utf8.decode(chunk)
+                return True
+        self.buf += self.utf8.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.decoder.JSONDecodeError('Expecting {!r}'.format(char), self.buf, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.decoder.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if (end == len(self.buf) or self.buf[end] not in ' \t\n\r,:]}') and self.fill():
+                # a number may continue in the next chunk
+                continue
+            self.pos = end
+            return value
+
+def iter_json_array_items(chunks, key):
+    '''Parses a JSON object from an iterable of byte chunks, yielding the items
+    of its array member `key` one at a time.'''
+    reader = JSONStreamReader(chunks)
+    reader.expect('{')
+    found = False
+    while reader.peek() != '}':
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            found = True
+            reader.expect('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                if reader.peek() == ',':
+                    reader.pos += 1
+            reader.expect(']')
+        else:
+            reader.value()
+        if reader.peek() == ',':
+            reader.pos += 1
+    reader.expect('}')
+    if not found:
+        raise KeyError(key)
+
+class BrowserWorker:
+    '''A long-lived browser that handles many portal fetches.
+
+    The browser is launched on first use and kept open between fetches; it is
+    only quit (and relaunched on the next fetch) after a failed fetch or once
+    it has served max_uses fetches.'''
+    def __init__(self, browser_type, max_uses=MAX_BROWSER_USES):
+        self.browser_type = browser_type
+        self.max_uses = max_uses
+        self.browser = None
+        self.uses = 0
+        self.launches = 0
+        self.fetches = 0
+        self.failures = 0
+        self.fetch_time = 0.0
+
+    def fetch(self, term, coursearea):
+        if self.browser is None:
+            from splinter import Browser
+            self.browser = Browser(self.browser_type, headless=True)
+            # without this a hung page load waits forever
+            self.browser.driver.set_page_load_timeout(PORTAL_PAGE_LOAD_TIMEOUT)
+            self.launches += 1
+            self.uses = 0
+        start = time.monotonic()
         try:
-            with Browser('chrome', headless=True) as browser:
-                return fetch_portal_with_browser(browser, term, coursearea)
+            html = fetch_portal_with_browser(self.browser, term, coursearea)
         except:
-            print('X', end='', flush=True, file=sys.stderr)
-    for i in range(MAX_PORTAL_FIREFOX_RETRIES):
+            self.failures += 1
+            self.recycle()
+            raise
+        self.fetch_time += time.monotonic() - start
+        self.fetches += 1
+        self.uses += 1
+        if self.uses >= self.max_uses:
+            self.recycle()
+        return html
+
+    def recycle(self):
+        if self.browser is not None:
+            try:
+                self.browser.quit()
+            except:
+                pass
+            self.browser = None
+
+    def stats(self):
+        return {'browser': self.browser_type,
+                'launches': self.launches,
+                'fetches': self.fetches,
+                'failures': self.failures,
+                'fetch_time': self.fetch_time}
+
+class HttpPortalWorker:
+    '''Fetches portal search results without a browser, by replaying the
+    Advanced Course Search form postbacks over a keep-alive session.'''
+    browser_type = 'http'
+
+    def __init__(self):
+        self.session = None
+        self.launches = 0
+        self.fetches = 0
+        self.failures = 0
+        self.fetch_time = 0.0
+
+    def fetch(self, term, coursearea):
+        if self.session is None:
+            # a new session (and cookies) for each launch, unlike the API's
+            self.session = fetching.new_session()
+            self.launches += 1
+        start = time.monotonic()
         try:
-            with Browser('firefox', headless=True) as browser:
-                return fetch_portal_with_browser(browser, term, coursearea)
+            html = fetch_portal_with_session(self.session, term, coursearea)
         except:
-            print('X', end='', flush=True, file=sys.stderr)
-    raise Exception('error fetching portal: term="{}", area="{}"'.format(term, coursearea))
+            self.failures += 1
+            self.recycle()
+            raise
+        self.fetch_time += time.monotonic() - start
+        self.fetches += 1
+        return html
+
+    def recycle(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    stats = BrowserWorker.stats
+
+# portal workers owned by this process, by browser type ('http' for the
+# browserless engine)
+_portal_workers = {}
+_browser_max_uses = MAX_BROWSER_USES
+_fetch_engine = 'browser'
+
+def get_portal_worker(browser_type):
+    if browser_type not in _portal_workers:
+        if not _portal_workers:
+            import multiprocessing.util
+            # pool worker processes exit without running atexit handlers,
+            # but multiprocessing finalizers still run
+            multiprocessing.util.Finalize(None, shutdown_portal_workers, exitpriority=10)
+        if browser_type == 'http':
+            _portal_workers[browser_type] = HttpPortalWorker()
+        else:
+            _portal_workers[browser_type] = BrowserWorker(browser_type, _browser_max_uses)
+    # at most one browser (or session) open per process, so that the cap on
+    # fetches in flight is a cap on browsers: falling back to another
+    # engine, or back from it, closes the one used before
+    for other_type, worker in _portal_workers.items():
+        if other_type != browser_type:
+            worker.recycle()
+    return _portal_workers[browser_type]
+
+def shutdown_portal_workers():
+    for worker in _portal_workers.values():
+        worker.recycle()
+
+def init_portal_worker_process(max_uses, fetch_engine, portal_url, profile_stages=(), profile_dir='.',
+                               cache_dir=None, archive_args=()):
+    global _browser_max_uses, _fetch_engine, PORTAL_URL
+    CACHE.directory = cache_dir
+    CACHE.drain_stats()
+    ARCHIVE.open(*archive_args)
+    # forked workers start with a copy of the parent's records and
+    # profiles so far
+    REPORT.drain()
+    REPORT.drain_warnings()
+    REPORT.profiles = {}
+    _browser_max_uses = max_uses
+    _fetch_engine = fetch_engine
+    PORTAL_URL = portal_url
+    REPORT.profile_stages = set(profile_stages)
+    REPORT.profile_dir = profile_dir
+    if profile_stages:
+        import multiprocessing.util
+        multiprocessing.util.Finalize(None, REPORT.dump_profiles, exitpriority=10)
+
+def init_pool_worker_process(*args):
+    '''init_portal_worker_process for a BrowserPool worker, which moves it
+    (and the browsers it starts) into a process group of its own, so that
+    a SIGTERM or ^C sent to the parent's group only reaches the parent: a
+    worker killed while it holds the pool's queue lock hangs the pool for
+    good. The parent stops the workers with BrowserPool.terminate().'''
+    os.setpgrp()
+    init_portal_worker_process(*args)
+
+def run_with_worker_stats(func_arg):
+    func, arg = func_arg
+    result = func(arg)
+    return (result, os.getpid(), [worker.stats() for worker in _portal_workers.values()], REPORT.drain(),
+            REPORT.drain_warnings(), CACHE.drain_stats())
+
+class BrowserPool:
+    '''A pool of worker processes that each keep their browsers (or HTTP
+    sessions) warm between fetches, and collect per-worker reuse counts and
+    fetch latency.'''
+    def __init__(self, processes=PORTAL_POOL_SIZE, max_uses=MAX_BROWSER_USES, fetch_engine='browser',
+                 profile_stages=(), profile_dir='.', cache_dir=None):
+        from multiprocessing import Pool
+        self.pool = Pool(processes=processes, initializer=init_pool_worker_process,
+                         initargs=(max_uses, fetch_engine, PORTAL_URL, profile_stages, profile_dir, cache_dir,
+                                   (ARCHIVE.directory, ARCHIVE.snapshot, ARCHIVE.mode)))
+        self.worker_stats = {}
+
+    def record(self, worker_result):
+        result, pid, stats, records, warnings, (cache_hits, cache_misses) = worker_result
+        self.worker_stats[pid] = stats
+        REPORT.extend(records)
+        REPORT.warnings += warnings
+        CACHE.hits += cache_hits
+        CACHE.misses += cache_misses
+        return result
+
+    def apply_async(self, func, arg, callback, error_callback):
+        self.pool.apply_async(run_with_worker_stats, ((func, arg),),
+                              callback=lambda worker_result: callback(self.record(worker_result)),
+                              error_callback=error_callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        '''Stops the workers, and the browsers they started, without
+        waiting for the jobs in flight.'''
+        import multiprocessing
+        # the pool's workers are this process's only children
+        groups = [process.pid for process in multiprocessing.active_children()]
+        self.pool.terminate()
+        self.pool.join()
+        for group in groups:
+            try:
+                os.killpg(group, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report(self, file=sys.stderr):
+        print('\nbrowser pool:', file=file)
+        for pid, stats in sorted(self.worker_stats.items()):
+            for s in stats:
+                mean = s['fetch_time'] / s['fetches'] if s['fetches'] else 0
+                print('  worker {} {}: {} fetches on {} launches ({} failed), {:.2f}s/fetch'.format(
+                      pid, s['browser'], s['fetches'], s['launches'], s['failures'], mean), file=file)
+
+class PortalScheduler:
+    '''A single priority queue of portal jobs (for any term or course area)
+    run on a BrowserPool, with a global cap on fetches in flight.'''
+    def __init__(self, browser_pool, max_in_flight=PORTAL_POOL_SIZE):
+        self.browser_pool = browser_pool
+        self.max_in_flight = max_in_flight
+        self.queue = []
+        self.order = itertools.count()
+        self.in_flight = 0
+        self.completed = 0
+        self.start_time = None
+
+    def submit(self, priority, func, arg):
+        '''Queues func(arg); lower priorities run first, ties in submit order.'''
+        heapq.heappush(self.queue, (priority, next(self.order), func, arg))
+
+    def run(self, on_error=None):
+        '''Yields (func, arg, result) for each job as it completes. A failed
+        job's error is raised here, unless on_error is given, in which case
+        on_error(func, arg, err) is called and the other jobs carry on.'''
+        done = queue.Queue()
+        self.start_time = time.monotonic()
+        while self.queue or self.in_flight:
+            while self.queue and self.in_flight < self.max_in_flight:
+                _, _, func, arg = heapq.heappop(self.queue)
+                self.browser_pool.apply_async(
+                    func, arg,
+                    callback=lambda result, func=func, arg=arg: done.put((func, arg, result, None)),
+                    error_callback=lambda err, func=func, arg=arg: done.put((func, arg, None, err)))
+                self.in_flight += 1
+            func, arg, result, err = done.get()
+            self.in_flight -= 1
+            if err is not None:
+                if on_error is None:
+                    raise err
+                on_error(func, arg, err)
+                continue
+            self.completed += 1
+            yield func, arg, result
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def throughput(self):
+        '''Completed jobs per second since run() started.'''
+        if self.start_time is None:
+            return 0.0
+        return self.completed / max(time.monotonic() - self.start_time, 1e-9)
+
+    def report(self, file=sys.stderr):
+        print('scheduler: {} jobs done, {} queued, {} in flight, {:.2f} jobs/s'.format(
+              self.completed, self.queue_depth(), self.in_flight, self.throughput()), file=file)
+
+# portal fetches by this process, which in a pool worker means its own
+PORTAL_BREAKER = fetching.CircuitBreaker(PORTAL_BREAKER_FAILURES, PORTAL_BREAKER_RESET)
+
+def print_portal_failure(err):
+    print('X', end='', flush=True, file=sys.stderr)
+
+def report_retries(file=sys.stderr):
+    totals = REPORT.totals()
+    for stage in ('api_fetch', 'portal_fetch'):
+        if stage in totals:
+            print('{}: {} fetches, {} failed attempts, {:.1f}s backing off'.format(
+                  stage, totals[stage]['count'], totals[stage].get('retries', 0),
+                  totals[stage].get('backoff_seconds', 0)), file=file)
+    # pool workers each have their own breaker, so count what it cut short
+    skipped = sum(1 for record in REPORT.records if record.get('circuit_open'))
+    if skipped:
+        print('portal_fetch: {} fetches cut short by the circuit breaker'.format(skipped), file=file)
+
+def fetch_portal(term=None, coursearea=None):
+    if ARCHIVE.replaying:
+        with REPORT.stage('portal_fetch', term=term, area=coursearea) as record:
+            data = ARCHIVE.get(archive.portal_key(term, coursearea))
+            record['bytes'] = len(data)
+        return data.decode('utf-8')
+    attempts = [('chrome', MAX_PORTAL_CHROME_RETRIES), ('firefox', MAX_PORTAL_FIREFOX_RETRIES)]
+    if _fetch_engine == 'http':
+        # fall back to a real browser
+        attempts.insert(0, ('http', MAX_PORTAL_HTTP_RETRIES))
+    with REPORT.stage('portal_fetch', term=term, area=coursearea, retries=0) as record:
+        for browser_type, retries in attempts:
+            try:
+                html = fetching.retry(lambda: get_portal_worker(browser_type).fetch(term, coursearea),
+                                      fetching.RetryPolicy(retries, PORTAL_BACKOFF_BASE, PORTAL_BACKOFF_MAX),
+                                      PORTAL_BREAKER, record, on_failure=print_portal_failure)
+            except fetching.CircuitOpen:
+                record['circuit_open'] = True
+                raise
+            except Exception:
+                continue
+            data = html.encode('utf-8')
+            record['browser'] = browser_type
+            record['bytes'] = len(data)
+            ARCHIVE.record(archive.portal_key(term, coursearea), data)
+            return html
+        raise Exception('error fetching portal: term="{}", area="{}"'.format(term, coursearea))
 
 def fetch_portal_with_browser(browser, term, coursearea):
     print('.', end='', flush=True, file=sys.stderr)
-    browser.visit('https://portal.hmc.edu/ICS/default.aspx?portlet=Course_Schedules&screen=Advanced+Course+Search')
+    browser.visit(PORTAL_URL)
     print('.', end='', flush=True, file=sys.stderr)
     if term is not None:
         term_selector = browser.find_by_id('pg0_V_ddlTerm').first
@@ -276,18 +1464,185 @@ def fetch_portal_with_browser(browser, term, coursearea):
     print('.', end='', flush=True, file=sys.stderr)
     return browser.html
 
-def fetch_portal_with_term(term):
-    return term, fetch_portal(term=term)
+POSTBACK_RE = re.compile(r"__doPostBack\(\s*'(?P<target>[^']*)'\s*,\s*'(?P<argument>[^']*)'\s*\)")
+def fetch_portal_with_session(session, term, coursearea):
+    '''Does what fetch_portal_with_browser does, but by posting the
+    ASP.NET form (viewstate, event validation and all) directly.'''
+    print('.', end='', flush=True, file=sys.stderr)
+    res = session.get(PORTAL_URL, timeout=PORTAL_TIMEOUT)
+    res.raise_for_status()
+    page = parse_response(res)
+    print('.', end='', flush=True, file=sys.stderr)
+    if term is not None:
+        term_selector = page.find(id='pg0_V_ddlTerm')
+        selected_term = form_selected_option(term_selector).get_text()
+        if term.replace(' ', '') != selected_term.replace(' ', ''):
+            fields = form_fields(page)
+            fields[term_selector['name']] = form_option_value(term_selector, term)
+            if 'doPostBack' in term_selector.get('onchange', ''):
+                # the term dropdown reloads the form (and its course areas)
+                res, page = post_form(session, res, page, fields, term_selector['name'])
+            else:
+                page = set_form_field(page, term_selector['name'], fields[term_selector['name']])
+    print('.', end='', flush=True, file=sys.stderr)
+    fields = form_fields(page)
+    if coursearea is None:
+        fields['pg0$V$txtTitleRestrictor'] = '*'
+    else:
+        coursearea_selector = page.find(id='pg0_V_ddlAdditional')
+        fields[coursearea_selector['name']] = form_option_value(coursearea_selector, coursearea)
+    res, page = click_form_control(session, res, page, fields, 'pg0_V_btnSearch')
+    print('.', end='', flush=True, file=sys.stderr)
+    if page.find(id='pg0_V_lnkShowAll') is not None:
+        res, page = click_form_control(session, res, page, form_fields(page), 'pg0_V_lnkShowAll')
+    print('.', end='', flush=True, file=sys.stderr)
+    return response_html(res)
+
+def response_encoding(res):
+    '''The charset the response's Content-Type names, if any. Without one,
+    requests takes text to be ISO-8859-1, which would turn the portal's
+    non-breaking spaces into two characters, so the page is left to
+    BeautifulSoup to decode by its <meta> charset or, failing that, its
+    bytes.'''
+    return res.encoding if 'charset' in res.headers.get('Content-Type', '').lower() else None
+
+def parse_response(res):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(res.content, 'lxml', from_encoding=response_encoding(res))
+
+def response_html(res):
+    from bs4 import UnicodeDammit
+    encoding = response_encoding(res)
+    return UnicodeDammit(res.content, [encoding] if encoding else [], is_html=True).unicode_markup
+
+def form_fields(page):
+    '''Collects the fields a browser would submit with the page's form.'''
+    fields = collections.OrderedDict()
+    form = page.find('form')
+    for element in form.find_all(['input', 'select', 'textarea']):
+        name = element.get('name')
+        if name is None or element.has_attr('disabled'):
+            continue
+        if element.name == 'select':
+            option = form_selected_option(element)
+            if option is not None:
+                fields[name] = option.get('value', option.get_text())
+        elif element.name == 'textarea':
+            fields[name] = element.get_text()
+        else:
+            input_type = element.get('type', 'text').lower()
+            if input_type in ('submit', 'button', 'image', 'reset', 'file'):
+                continue
+            if input_type in ('checkbox', 'radio') and not element.has_attr('checked'):
+                continue
+            fields[name] = element.get('value', 'on' if input_type in ('checkbox', 'radio') else '')
+    return fields
+
+def form_selected_option(select):
+    option = select.find('option', selected=True)
+    if option is None:
+        option = select.find('option')
+    return option
+
+def form_option_value(select, text):
+    for option in select.find_all('option'):
+        if option.get_text().strip() == text.strip():
+            return option.get('value', option.get_text())
+    raise ValueError('no option {!r} in {}'.format(text, select.get('id')))
+
+def set_form_field(page, name, value):
+    select = page.find('select', attrs={'name': name})
+    for option in select.find_all('option'):
+        if option.get('value', option.get_text()) == value:
+            option['selected'] = 'selected'
+        elif option.has_attr('selected'):
+            del option['selected']
+    return page
+
+def click_form_control(session, res, page, fields, control_id):
+    '''Submits the form the way clicking the given link or button would.'''
+    control = page.find(id=control_id)
+    m = POSTBACK_RE.search(control.get('href', '') + control.get('onclick', ''))
+    if m:
+        return post_form(session, res, page, fields, m.group('target'), m.group('argument'))
+    fields[control['name']] = control.get('value', '')
+    return post_form(session, res, page, fields)
+
+def post_form(session, res, page, fields, event_target='', event_argument=''):
+    fields['__EVENTTARGET'] = event_target
+    fields['__EVENTARGUMENT'] = event_argument
+    action = urllib.parse.urljoin(res.url, page.find('form').get('action', ''))
+    res = session.post(action, data=fields, timeout=PORTAL_TIMEOUT)
+    res.raise_for_status()
+    return res, parse_response(res)
 
 def fetch_portal_with_coursearea(term_coursearea):
     term = term_coursearea[0]
     coursearea = term_coursearea[1]
     return coursearea, fetch_portal(term=term, coursearea=coursearea)
 
+# the fetch_and_parse_* functions run in the pool workers, so only the
+# parsed data is sent back to the parent, not the whole page
+
+def fetch_and_parse_portal_term(term):
+    return term, parse_portal_html_with_report(fetch_portal(term=term), term=term)
+
+def fetch_and_parse_portal_term_cached(term_api_hash):
+    '''Fetches a term's page and returns (term, cache key of its merge with
+    the term's API data, parsed classes). The page is only parsed if
+    neither the merged nor the parsed data is cached; if the merged data
+    is, the classes returned are None.'''
+    term, api_hash = term_api_hash
+    portal_html = fetch_portal(term=term)
+    page_hash = cache.content_hash(portal_html)
+    merged_key = CACHE.key('merged', page_hash, api_hash or '')
+    if CACHE.directory is not None and os.path.exists(CACHE.path(merged_key)):
+        return term, merged_key, None
+    parsed_key = CACHE.key('parsed', page_hash)
+    classes = CACHE.load(parsed_key)
+    if classes is None:
+        classes = parse_portal_html_with_report(portal_html, term=term)
+        CACHE.store(parsed_key, classes)
+    return term, merged_key, classes
+
+def api_term_hash(api_classes_by_term, term):
+    if CACHE.directory is None or term not in api_classes_by_term:
+        return None
+    return cache.content_hash(json.dumps(api_classes_by_term[term], separators=(',',':')))
+
+def fetch_and_parse_portal_coursearea(term_coursearea):
+    coursearea, data = fetch_portal_with_coursearea(term_coursearea)
+    key = CACHE.key('area', data)
+    areamap = CACHE.load(key)
+    if areamap is None:
+        courses = parse_portal_html_with_report(data, term=term_coursearea[0], area=coursearea)
+        areamap = {course_id: [section['section_id'] for section in course['sections'].values()]
+                   for course_id, course in courses.items()}
+        CACHE.store(key, areamap)
+    return coursearea, areamap
+
+def parse_portal_html_with_report(portal_html, **labels):
+    with REPORT.stage('parse', **labels) as record:
+        classes = parse_portal_html(portal_html)
+        record['rows'] = sum(len(course['sections']) for course in classes.values())
+    return classes
+
 def fetch_portal_info():
+    '''(selected term, all terms, course areas) from the search form.'''
+    if ARCHIVE.replaying:
+        return tuple(json.loads(ARCHIVE.get(archive.PORTAL_INFO_KEY)))
+    info = fetching.retry(read_portal_info,
+                          fetching.RetryPolicy(MAX_PORTAL_CHROME_RETRIES, PORTAL_BACKOFF_BASE, PORTAL_BACKOFF_MAX),
+                          PORTAL_BREAKER, on_failure=print_portal_failure)
+    ARCHIVE.record(archive.PORTAL_INFO_KEY, json.dumps(info).encode('utf-8'))
+    return info
+
+def read_portal_info():
+    from splinter import Browser
     with Browser('chrome', headless=True) as browser:
+        browser.driver.set_page_load_timeout(PORTAL_PAGE_LOAD_TIMEOUT)
         print('.', end='', flush=True, file=sys.stderr)
-        browser.visit('https://portal.hmc.edu/ICS/default.aspx?portlet=Course_Schedules&screen=Advanced+Course+Search')
+        browser.visit(PORTAL_URL)
         print('.', end='', flush=True, file=sys.stderr)
         term_selector = browser.find_by_id('pg0_V_ddlTerm').first
         terms = [element.text for element in term_selector.find_by_tag('option')]
@@ -302,18 +1657,8 @@ def fetch_portal_info():
 
     return selected_term, terms
 
-def fetch_portal_terms(terms):
-    portal_data = {}
-
-    pool = Pool(processes=min(len(terms), 10))
-    portal_data_list = pool.map(fetch_portal_with_term, terms)
-
-    for term, data in portal_data_list:
-        portal_data[term] = data
-
-    return portal_data
-
 def get_portal_table(portal_html):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(portal_html, 'lxml')
     print('.', end='', flush=True, file=sys.stderr)
     return soup.select('#pg0_V_dgCourses > tbody.gbody > tr')
@@ -330,37 +1675,81 @@ def can_merge(a, b, allow_substring=False):
     else:
         return a == b
 
+def freeze(value):
+    '''Hashable stand-in for a JSON-like value that compares (and hashes)
+    equal exactly when the values do.'''
+    if isinstance(value, dict):
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    else:
+        return value
+
 def merge_unordered_lists(a, b, allow_substring=False):
     if a == b:
         return True
     if len(a) != len(b):
         return False
+    # items with an exact match may only be paired with exact matches
+    b_by_value = collections.defaultdict(list)
+    for i, b_itm in enumerate(b):
+        b_by_value[freeze(b_itm)].append(i)
+    a_values = {freeze(a_itm) for a_itm in a}
+    unmatched_b = [i for i, b_itm in enumerate(b) if freeze(b_itm) not in a_values]
     merge_map = []
     for a_itm in a:
-        merge_map.append([i for i, b_itm in enumerate(b) if a_itm == b_itm])
+        merge_map.append(b_by_value.get(freeze(a_itm), []))
         if len(merge_map[-1]) == 0:
-            merge_map[-1] = [i for i, b_itm in enumerate(b) if not b_itm in a and can_merge(a_itm, b_itm, allow_substring)]
-    idx_set = set()
-    idx_list = [0]*len(a)
-    a_i = 0
-    if not get_merge_order(a_i, idx_list, idx_set, merge_map):
+            merge_map[-1] = [i for i in unmatched_b if can_merge(a_itm, b[i], allow_substring)]
+    idx_list = get_merge_order(merge_map)
+    if idx_list is None:
         return False
     for a_i, b_i in enumerate(idx_list):
         if isinstance(a[a_i], dict) and isinstance(b[b_i], dict):
             merge(a[a_i], b[b_i])
     return True
 
-def get_merge_order(a_i, idx_list, idx_set, merge_map):
-    if a_i == len(idx_list):
-        return True
+def get_merge_order(merge_map):
+    '''Finds the perfect matching of a-indices to b-indices allowed by
+    merge_map that pairs each a-index, in order, with the earliest b-index
+    it can have; returns None if there is no perfect matching.'''
+    match_a = [None] * len(merge_map)
+    match_b = {}
+    for a_i in range(len(merge_map)):
+        if not augment_merge_order(a_i, merge_map, match_a, match_b, set(), set()):
+            return None
+    # walk the a-indices in order, moving each to its earliest possible
+    # b-index by re-matching the later a-indices around it
+    fixed = set()
+    for a_i in range(len(merge_map)):
+        fixed.add(a_i)
+        for b_i in merge_map[a_i]:
+            if match_a[a_i] == b_i:
+                break
+            other = match_b[b_i]
+            if other in fixed:
+                continue
+            old_b_i = match_a[a_i]
+            saved_a, saved_b = list(match_a), dict(match_b)
+            match_a[a_i], match_b[b_i] = b_i, a_i
+            del match_b[old_b_i]
+            match_a[other] = None
+            if augment_merge_order(other, merge_map, match_a, match_b, fixed, set()):
+                break
+            match_a, match_b = saved_a, saved_b
+    return match_a
+
+def augment_merge_order(a_i, merge_map, match_a, match_b, fixed, seen):
     for b_i in merge_map[a_i]:
-        if b_i in idx_set:
+        if b_i in seen:
             continue
-        idx_set.add(b_i)
-        idx_list[a_i] = b_i
-        if get_merge_order(a_i + 1, idx_list, idx_set, merge_map):
+        seen.add(b_i)
+        other = match_b.get(b_i)
+        if other is None or (other not in fixed and
+                             augment_merge_order(other, merge_map, match_a, match_b, fixed, seen)):
+            match_a[a_i] = b_i
+            match_b[b_i] = a_i
             return True
-        idx_set.remove(b_i)
     return False
 
 def merge(a, b, path=None):
@@ -369,7 +1758,9 @@ def merge(a, b, path=None):
     for key in b:
         if key in a:
             if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)])
+                path.append(str(key))
+                merge(a[key], b[key], path)
+                path.pop()
                 continue
             if a[key] == b[key]:
                 continue # same leaf value
@@ -377,46 +1768,215 @@ def merge(a, b, path=None):
                 # merge scheduleparts lists by merging components
                 if merge_unordered_lists(a[key], b[key], key == 'instructors'):
                     continue
-            print('Error: conflict at {}: {!r} != {!r}'.format(
-                        '/'.join(path + [str(key)]), a[key], b[key]), file=sys.stderr)
+            REPORT.warn('Error: conflict at {}: {!r} != {!r}'.format(
+                        '/'.join(path + [str(key)]), a[key], b[key]))
         else:
             a[key] = b[key]
     return a
 
+# keys tuples shared between records with the same keys in the same order
+_interned_keys = {}
+
+def intern_keys(keys):
+    interned = _interned_keys.get(keys)
+    if interned is None:
+        if len(_interned_keys) >= MAX_MEMO_ENTRIES:
+            _interned_keys.clear()
+        interned = _interned_keys[keys] = keys
+    return interned
+
+def compact_value(value):
+    '''Compact, immutable form of a JSON-like value: strings are interned,
+    lists become tuples and dicts become PackedDicts.'''
+    if isinstance(value, str):
+        return sys.intern(value)
+    elif isinstance(value, list):
+        return tuple(compact_value(item) for item in value)
+    elif isinstance(value, dict):
+        return PackedDict(value)
+    else:
+        return value
+
+def compact_to_json(value):
+    '''json.dump default= hook for the compact types.'''
+    if isinstance(value, (Record, PackedDict)):
+        return value.to_json()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+def expand_compact(value):
+    '''Turns compact values back into plain dicts and lists.'''
+    if isinstance(value, (Record, PackedDict)):
+        value = value.to_json()
+    if isinstance(value, dict):
+        return value.__class__((key, expand_compact(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [expand_compact(item) for item in value]
+    else:
+        return value
+
+class PackedDict:
+    '''A small dict stored as a shared keys tuple and a values tuple.'''
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, data):
+        self._keys = intern_keys(tuple(sys.intern(key) if isinstance(key, str) else key for key in data))
+        self._values = tuple(compact_value(item) for item in data.values())
+
+    def __getitem__(self, key):
+        return self._values[self._keys.index(key)]
+
+    def __eq__(self, other):
+        return isinstance(other, PackedDict) and self.to_json() == other.to_json()
+
+    def to_json(self):
+        return dict(zip(self._keys, self._values))
+
+class Record:
+    '''Slotted stand-in for one of the dicts the scraper builds. It keeps
+    the dict's keys in order, so to_json() gives back an equal dict that
+    serializes to the same bytes; keys without a slot go in _extra.'''
+    __slots__ = ('_keys', '_extra')
+    FIELDS = frozenset()
+
+    def __init__(self, data):
+        self._keys = intern_keys(tuple(data))
+        self._extra = None
+        for key, value in data.items():
+            value = self.pack(key, value)
+            if key in self.FIELDS:
+                setattr(self, key, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+
+    def pack(self, key, value):
+        return compact_value(value)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self._extra[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_json() == other.to_json()
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+    def keys(self):
+        return self._keys
+
+    def to_json(self):
+        return {key: self[key] for key in self._keys}
+
+class SchedulePart(Record):
+    __slots__ = ('days', 'start', 'start_ampm', 'end', 'end_ampm', 'campus', 'building', 'room',
+                 'start_date', 'end_date', 'start_time', 'end_time', 'site')
+    FIELDS = frozenset(__slots__)
+
+class Section(Record):
+    __slots__ = ('section_id', 'id', 'campus', 'section', 'id_data', 'name', 'instructors',
+                 'currentEnrollment', 'capacity', 'status', 'scheduleStrings', 'credits',
+                 'startDate', 'endDate', 'schedule')
+    FIELDS = frozenset(__slots__)
+
+    def pack(self, key, value):
+        if key == 'schedule' and isinstance(value, list):
+            return tuple(SchedulePart(part) if isinstance(part, dict) else compact_value(part)
+                         for part in value)
+        return compact_value(value)
+
+class Course(Record):
+    __slots__ = ('sections', 'id', 'campus', 'name', 'description')
+    FIELDS = frozenset(__slots__)
+
+    def pack(self, key, value):
+        if key == 'sections' and isinstance(value, dict):
+            return {section: Section(section_data) if isinstance(section_data, dict) else compact_value(section_data)
+                    for section, section_data in value.items()}
+        return compact_value(value)
+
+def compact_term(classes):
+    '''Compact form of one term's classes (course id -> course dict).'''
+    return collections.OrderedDict((course_id, Course(course) if isinstance(course, dict) else course)
+                                   for course_id, course in classes.items())
+
 def parse_portal_table(portal_table):
+    return parse_portal_sections(parse_section(row) for row in portal_table
+                                 if (not row.has_attr('class')) or ('subItem' not in row['class']))
+
+def parse_portal_html(portal_html):
+    '''parse_portal_table(get_portal_table(portal_html)), without building a
+    tree of the whole page.'''
+    classes = parse_portal_sections(iter_portal_sections(portal_html))
+    print('.', end='', flush=True, file=sys.stderr)
+    return classes
+
+def parse_portal_sections(sections):
     classes = collections.OrderedDict()
 
-    for row in portal_table:
-        if (not row.has_attr('class')) or ('subItem' not in row['class']):
-            section_data = parse_section(row)
-            if section_data['id'] in classes and section_data['section'] in classes[class_data['id']]['sections']:
-                print('Error: duplicated section {} for {}'.format(section_data['section'], class_data['id']), file=sys.stderr)
-                i = 1
-                while '{}.{}'.format(section_data['section'], i) in classes[class_data['id']]['sections']:
-                    i += 1
-                section_data['section'] = '{}.{}'.format(section_data['section'], i)
-            class_data = {
-                'sections': {
-                    section_data['section']: section_data,
-                },
-                'id': section_data['id'],
-                'campus': section_data['campus'],
-                'name': section_data['name'],
-            }
-            if class_data['id'] not in classes:
-                classes[class_data['id']] = {'sections': {}}
-            merge(classes[class_data['id']], class_data)
+    for section_data in sections:
+        if section_data['id'] in classes and section_data['section'] in classes[class_data['id']]['sections']:
+            REPORT.warn('Error: duplicated section {} for {}'.format(section_data['section'], class_data['id']))
+            i = 1
+            while '{}.{}'.format(section_data['section'], i) in classes[class_data['id']]['sections']:
+                i += 1
+            section_data['section'] = '{}.{}'.format(section_data['section'], i)
+        class_data = {
+            'sections': {
+                section_data['section']: section_data,
+            },
+            'id': section_data['id'],
+            'campus': section_data['campus'],
+            'name': section_data['name'],
+        }
+        if class_data['id'] not in classes:
+            classes[class_data['id']] = {'sections': {}}
+        merge(classes[class_data['id']], class_data)
 
     return classes
 
-def fetch_some_portal_classes(terms):
-    portal_terms = fetch_portal_terms(terms)
-    classes_by_term = {}
-    for term in portal_terms:
-        print(term)
-        classes_by_term[term] = parse_portal_table(get_portal_table(portal_terms[term]))
+def lxml_etree():
+    '''lxml.etree, imported on first use.'''
+    import lxml.etree
+    return lxml.etree
+
+PORTAL_GRID_ID = 'pg0_V_dgCourses'
+def iter_portal_sections(portal_html):
+    '''Yields parse_section() of each row of the course grid, parsing the
+    page incrementally and discarding each row (and everything outside the
+    grid) once it is done with.'''
+    if isinstance(portal_html, str):
+        portal_html = portal_html.encode('utf-8')
+    grid = None
+    for event, element in lxml_etree().iterparse(io.BytesIO(portal_html), events=('start', 'end'),
+                                                 html=True, encoding='utf-8'):
+        if event == 'start':
+            if grid is None and element.tag == 'table' and element.get('id') == PORTAL_GRID_ID:
+                grid = element
+            continue
+        if grid is None:
+            element.clear()
+        elif element is grid:
+            grid = None
+            element.clear()
+        elif element.tag == 'tr' and is_portal_grid_row(element, grid):
+            if 'subItem' not in element.get('class', '').split():
+                yield parse_section_element(element)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
-    return classes_by_term
+def is_portal_grid_row(row, grid):
+    tbody = row.getparent()
+    return (tbody is not None and tbody.tag == 'tbody' and tbody.getparent() is grid and
+            'gbody' in tbody.get('class', '').split())
 
 CLASS_ID_RE_STR = r'''
     ^
@@ -450,39 +2010,79 @@ SECTION_ID_RE_ARR = [
 ]
 SIMPLE_SECTION_ID_RE = re.compile(SIMPLE_CLASS_ID_RE_STR + SECTION_ID_RE_STR, re.VERBOSE)
 REALLY_SIMPLE_SECTION_ID_RE = re.compile(SIMPLE_CLASS_ID_RE_STR + '-(?P<section> [0-9]+)$', re.VERBOSE)
+# id_data of each section id parse_section_id() has matched; every term of a
+# section, in the API and the portal, has the same id
+_section_ids = {}
+
 def parse_section_id(section_id):
+    id_data = _section_ids.get(section_id)
+    if id_data is not None:
+        # a new dict each time, as callers add to what they get
+        id_data = dict(id_data)
+        return {'id': id_data['id'], 'campus': id_data['campus'], 'section': id_data['section'], 'id_data': id_data}
     for id_re in SECTION_ID_RE_ARR:
         id_match = id_re.match(section_id)
         if id_match:
             break
     else:
-        print('error: no match for ' + section_id, file=sys.stderr)
+        REPORT.warn('error: no match for ' + section_id)
         return {'id': section_id, 'section': 0, 'campus': '??'}
     id_data = id_match.groupdict()
     id_data['section'] = int(id_data['section'])
     if 'number_only' in id_data:
         id_data['number_only'] = int(id_data['number_only'])
     if 'campus' not in id_data:
-        print('error: missing campus for ' + section_id, file=sys.stderr)
+        REPORT.warn('error: missing campus for ' + section_id)
         id_data['campus'] = '??'
+    else:
+        # ids with errors aren't kept, so each use reports them
+        if len(_section_ids) >= MAX_MEMO_ENTRIES:
+            _section_ids.clear()
+        _section_ids[section_id] = dict(id_data)
     return {'id': id_data['id'], 'campus': id_data['campus'], 'section': id_data['section'], 'id_data': id_data}
 
 def parse_section(class_row):
     columns = list(class_row.find_all('td', recursive=False))
+    return parse_section_strings(
+        str(columns[1].a.string),
+        str(columns[2].string),
+        to_list(columns[3]),
+        str(columns[4].string),
+        str(columns[5].string),
+        to_list(columns[6]),
+        columns[7].string,
+        str(columns[8].string),
+        str(columns[9].string))
+
+def parse_section_element(class_row):
+    '''parse_section for an lxml row element.'''
+    columns = [column for column in class_row if column.tag == 'td']
+    return parse_section_strings(
+        str(element_string(columns[1].find('.//a'))),
+        str(element_string(columns[2])),
+        element_to_list(columns[3]),
+        str(element_string(columns[4])),
+        str(element_string(columns[5])),
+        element_to_list(columns[6]),
+        element_string(columns[7]),
+        str(element_string(columns[8])),
+        str(element_string(columns[9])))
+
+def parse_section_strings(section_id, name, instructors, enrollment_info, status,
+                          schedule_strings, credits, start_date, end_date):
     class_data = {}
     
-    class_data['section_id'] = str(columns[1].a.string)
+    class_data['section_id'] = section_id
     class_data.update(parse_section_id(class_data['section_id']))
-    class_data['name'] = str(columns[2].string).strip()
-    class_data['instructors'] = to_list(columns[3])
-    enrollment_info = str(columns[4].string)
+    class_data['name'] = name.strip()
+    class_data['instructors'] = instructors
     class_data['currentEnrollment'] = int(enrollment_info.split('/')[0])
     class_data['capacity'] = int(enrollment_info.split('/')[1])
-    class_data['status'] = str(columns[5].string)
-    class_data['scheduleStrings'] = to_list(columns[6])
-    class_data['credits'] = float(columns[7].string)
-    class_data['startDate'] = reformat_date(str(columns[8].string))
-    class_data['endDate'] = reformat_date(str(columns[9].string))
+    class_data['status'] = status
+    class_data['scheduleStrings'] = schedule_strings
+    class_data['credits'] = float(credits)
+    class_data['startDate'] = reformat_date(start_date)
+    class_data['endDate'] = reformat_date(end_date)
     class_data['schedule'] = parse_schedule(class_data['scheduleStrings'], class_data['startDate'], class_data['endDate'])
 
     return class_data
@@ -490,6 +2090,20 @@ def parse_section(class_row):
 def to_list(cell):
     return [str(child.string).strip() for child in cell.ul.find_all('li', recursive=False)]
 
+def element_to_list(cell):
+    return [str(element_string(child)).strip() for child in cell.find('.//ul') if child.tag == 'li']
+
+def element_string(element):
+    '''What BeautifulSoup's .string would be for an lxml element.'''
+    if element.tag is lxml_etree().Comment:
+        return element.text
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        return element_string(children[0])
+    return None
+
 SCHEDULE_RE = re.compile(r'''
     ^
     (?:
@@ -531,11 +2145,11 @@ def parse_schedule(schedule_strings, start_date, end_date):
     for timestr in schedule_strings:
         m = SCHEDULE_RE.match(timestr)
         if not m:
-            print('unmatched schedule string: {}'.format(timestr), file=sys.stderr)
+            REPORT.warn('unmatched schedule string: {}'.format(timestr))
             timestr = timestr.replace('208', '2018')
             m = SCHEDULE_RE.match(timestr)
             if not m:
-               print('still not matched', file=sys.stderr)
+               REPORT.warn('still not matched')
                schedule.append({'start_date': start_date, 'end_date': end_date})
                continue
         schedule_part = m.groupdict()
@@ -573,19 +2187,5 @@ DATE_RE = re.compile('^(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})$')
 def reformat_date(date_str):
     return '{year}-{month:0>2}-{day:0>2}'.format(**DATE_RE.match(date_str).groupdict())
 
-def fetch_portal_areamap(term, courseareas):
-    areamap = {}
-
-    pool = Pool(processes=min(len(courseareas), 10))
-    portal_data_list = pool.map(fetch_portal_with_coursearea, [(term, area) for area in courseareas])
-
-    for coursearea, data in portal_data_list:
-        courses = parse_portal_table(get_portal_table(data))
-        areamap[coursearea] = {course_id: [section['section_id'] for section in course['sections'].values()]
-                         for course_id, course in courses.items()}
-        print('.', end='', flush=True, file=sys.stderr)
-
-    return areamap
-
 if __name__ == '__main__':
     main()
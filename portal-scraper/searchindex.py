@@ -0,0 +1,109 @@
+'''Inverted index of a term's courses, so the front-end's search boxes are
+lookups rather than scans of every course.
+
+An index is {"courses": [course id, ...], "fields": {field: {"tokens":
+[...], "postings": [...]}}, "areas": {area: [...]}}. Courses are numbered
+by their place in "courses" (term order). For each field, "tokens" is
+sorted and postings[i] lists the courses with a word equal to tokens[i],
+so a lookup goes through the field's distinct words rather than every
+course. "areas" lists the courses in each course area of the term's
+infomap.
+
+A word is a run of letters and digits, lowercased with accents dropped;
+course ids are also split where letters meet digits, so "CSCI005" can be
+found as "csci", "005" or "csci005". The front-end's search boxes match
+text anywhere in a field, so a lookup only narrows the courses down to
+those where every word of the query is part of a word of the field (which
+any course containing the query is); search() here and searchIndex() in
+scheduler.js find those, and the front-end then checks the text itself.'''
+
+import argparse
+import json
+import re
+import unicodedata
+
+FIELDS = ('name', 'id', 'instructors', 'description')
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+# what NFKD splits accents off into
+COMBINING_RE = re.compile('[\u0300-\u036f]')
+ID_PART_RE = re.compile(r'[a-z]+|[0-9]+')
+# shorter description words are mostly "a", "of", "to" and such
+MIN_DESCRIPTION_TOKEN = 3
+
+def tokens(text):
+    return TOKEN_RE.findall(COMBINING_RE.sub('', unicodedata.normalize('NFKD', text)).lower())
+
+def course_tokens(course_id, course):
+    '''(field, token) for each word of the course, repeats included.'''
+    sections = list(course['sections'].values())
+    for name in [course.get('name')] + [section.get('name') for section in sections]:
+        for token in tokens(name or ''):
+            yield 'name', token
+    for token in tokens(course_id):
+        yield 'id', token
+        for part in ID_PART_RE.findall(token):
+            yield 'id', part
+    for section in sections:
+        for instructor in section.get('instructors') or ():
+            for token in tokens(instructor):
+                yield 'instructors', token
+    for token in tokens(course.get('description') or ''):
+        if len(token) >= MIN_DESCRIPTION_TOKEN:
+            yield 'description', token
+
+def build_index(classes, infomap=None):
+    '''Index of one term's classes (course id -> course), with the course
+    areas of its infomap if given.'''
+    fields = {field: {} for field in FIELDS}
+    for i, (course_id, course) in enumerate(classes.items()):
+        for field, token in course_tokens(course_id, course):
+            postings = fields[field].setdefault(token, [])
+            if not postings or postings[-1] != i:
+                postings.append(i)
+    index = {'courses': list(classes),
+             'fields': {field: {'tokens': sorted(postings),
+                                'postings': [postings[token] for token in sorted(postings)]}
+                        for field, postings in fields.items()}}
+    if infomap is not None:
+        position = {course_id: i for i, course_id in enumerate(classes)}
+        index['areas'] = {area: sorted(position[course_id] for course_id in courses if course_id in position)
+                          for area, courses in infomap.items()}
+    return index
+
+def substring_matches(index, field, word):
+    '''Set of courses (by number) with a word in field containing word.'''
+    field_index = index['fields'][field]
+    matches = set()
+    for token, postings in zip(field_index['tokens'], field_index['postings']):
+        if word in token:
+            matches.update(postings)
+    return matches
+
+def search(index, text, field='name', area=None):
+    '''Ids of the courses, in term order, with every word of text part of
+    a word in field, and in the given course area if any.'''
+    matches = None
+    for word in tokens(text):
+        word_matches = substring_matches(index, field, word)
+        matches = word_matches if matches is None else matches & word_matches
+    if area is not None:
+        area_matches = set(index.get('areas', {}).get(area, ()))
+        matches = area_matches if matches is None else matches & area_matches
+    if matches is None:
+        return list(index['courses'])
+    return [index['courses'][i] for i in sorted(matches)]
+
+def main():
+    parser = argparse.ArgumentParser(description='look courses up in a <term>_search.json index')
+    parser.add_argument('index')
+    parser.add_argument('text', nargs='?', default='')
+    parser.add_argument('--field', choices=FIELDS, default='name', action='store')
+    parser.add_argument('--area', action='store')
+    args = parser.parse_args()
+    with open(args.index) as f:
+        index = json.load(f)
+    for course_id in search(index, args.text, args.field, args.area):
+        print(course_id)
+
+if __name__ == '__main__':
+    main()
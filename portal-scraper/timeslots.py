@@ -0,0 +1,164 @@
+'''Weekly occupancy bitmasks for sections, so schedule conflicts become
+bitwise ANDs.
+
+A section's meetings are grouped by the date range they run over; each
+group becomes one mask with a bit per SLOT_MINUTES of the week, starting
+Sunday at midnight. Two sections conflict if any of their groups have
+overlapping date ranges and masks that share a bit. with_slot_masks()
+puts each section's masks in its "slots" field, which is what
+slotMasksConflict() in scheduler.js checks.'''
+
+import base64
+import itertools
+
+import numpy as np
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+# rows of the occupancy array painted at a time, to bound memory
+BLOCK_ROWS = 1024
+DAY_INDEX = {'U': 0, 'M': 1, 'T': 2, 'W': 3, 'R': 4, 'F': 5, 'S': 6}
+
+def get(data, key):
+    return data[key] if key in data else None
+
+def time_to_minutes(time_str):
+    hours, minutes = time_str.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+def schedule_part_slots(part):
+    '''(day, first slot, end slot) for each day the schedule part meets.'''
+    days, start_time, end_time = get(part, 'days'), get(part, 'start_time'), get(part, 'end_time')
+    if not days or start_time is None or end_time is None:
+        return []
+    start = time_to_minutes(start_time) // SLOT_MINUTES
+    end = -(-time_to_minutes(end_time) // SLOT_MINUTES)
+    if end <= start:
+        return []
+    return [(DAY_INDEX[day], start, end) for day in days if day in DAY_INDEX]
+
+def section_date_groups(section):
+    '''The section's schedule parts, grouped by (start date, end date).'''
+    groups = {}
+    for part in get(section, 'schedule') or ():
+        dates = (get(part, 'start_date') or get(section, 'startDate'),
+                 get(part, 'end_date') or get(section, 'endDate'))
+        groups.setdefault(dates, []).append(part)
+    return groups
+
+def section_slot_masks(section):
+    '''Reference version of term_slot_masks for one section: a list of
+    (start date, end date, mask as an int).'''
+    masks = []
+    for (start_date, end_date), parts in section_date_groups(section).items():
+        mask = 0
+        for part in parts:
+            for day, start, end in schedule_part_slots(part):
+                first = day * SLOTS_PER_DAY + start
+                mask |= ((1 << (end - start)) - 1) << (SLOTS_PER_WEEK - first - (end - start))
+        if mask:
+            masks.append((start_date, end_date, mask))
+    return masks
+
+def term_slot_masks(classes):
+    '''Masks for every section of a term, as
+    {course id: {section: [[start date, end date, base64 mask], ...]}}.
+
+    All the term's meetings are painted into one array at once, so this is
+    the one to use for whole terms.'''
+    rows = []
+    meetings = []
+    for course_id, course in classes.items():
+        for section, section_data in course['sections'].items():
+            for dates, parts in section_date_groups(section_data).items():
+                row = len(rows)
+                rows.append((course_id, section, dates))
+                for part in parts:
+                    for day, start, end in schedule_part_slots(part):
+                        meetings.append((row, day * SLOTS_PER_DAY + start, day * SLOTS_PER_DAY + end))
+    meetings = np.array(meetings, dtype=np.int64).reshape(-1, 3)
+    packed = np.zeros((len(rows), SLOTS_PER_WEEK // 8), dtype=np.uint8)
+    for first in range(0, len(rows), BLOCK_ROWS):
+        # mark where each meeting starts and ends, then a running sum along
+        # the week fills in the slots between
+        block = meetings[(meetings[:, 0] >= first) & (meetings[:, 0] < first + BLOCK_ROWS)]
+        occupancy = np.zeros((min(BLOCK_ROWS, len(rows) - first), SLOTS_PER_WEEK + 1), dtype=np.int16)
+        np.add.at(occupancy, (block[:, 0] - first, block[:, 1]), 1)
+        np.add.at(occupancy, (block[:, 0] - first, block[:, 2]), -1)
+        np.cumsum(occupancy, axis=1, dtype=np.int16, out=occupancy)
+        packed[first:first + BLOCK_ROWS] = np.packbits(occupancy[:, :SLOTS_PER_WEEK] > 0, axis=1)
+    occupied = packed.any(axis=1)
+    masks = {}
+    for (course_id, section, (start_date, end_date)), mask, used in zip(rows, packed, occupied):
+        section_masks = masks.setdefault(course_id, {}).setdefault(section, [])
+        if used:
+            section_masks.append([start_date, end_date, base64.b64encode(mask.tobytes()).decode('ascii')])
+    return masks
+
+def with_slot_masks(classes):
+    '''A copy of a term's classes (course id -> course) with each section's
+    masks (as term_slot_masks() gives them) in its "slots" field. Courses
+    and sections are copied into plain dicts; their values are shared.'''
+    masks = term_slot_masks(classes)
+    result = {}
+    for course_id, course in classes.items():
+        course = dict(course)
+        course['sections'] = {section: dict(section_data, slots=masks.get(course_id, {}).get(section, []))
+                              for section, section_data in course['sections'].items()}
+        result[course_id] = course
+    return result
+
+def decode_mask(encoded):
+    return int.from_bytes(base64.b64decode(encoded), 'big')
+
+def decode_section_masks(section_masks):
+    return [(start_date, end_date, decode_mask(encoded)) for start_date, end_date, encoded in section_masks]
+
+def dates_overlap(start_a, end_a, start_b, end_b):
+    # ISO dates compare as strings; a missing date is unbounded
+    return ((start_a is None or end_b is None or start_a <= end_b) and
+            (start_b is None or end_a is None or start_b <= end_a))
+
+def masks_conflict(masks_a, masks_b):
+    '''Whether two sections, given as decoded mask lists, ever meet at once.'''
+    for start_a, end_a, mask_a in masks_a:
+        for start_b, end_b, mask_b in masks_b:
+            if mask_a & mask_b and dates_overlap(start_a, end_a, start_b, end_b):
+                return True
+    return False
+
+def conflict_free_schedules(courses):
+    '''Yields every choice of one section per course with no conflicts.
+
+    courses is a list of {section: decoded mask list}; each schedule is
+    yielded as a tuple of sections, one per course, in the same order.'''
+    options = [list(sections.items()) for sections in courses]
+    chosen = []
+
+    def extend(i):
+        if i == len(options):
+            yield tuple(section for section, _ in chosen)
+            return
+        for section, masks in options[i]:
+            if any(masks_conflict(masks, other) for _, other in chosen):
+                continue
+            chosen.append((section, masks))
+            yield from extend(i + 1)
+            chosen.pop()
+
+    return extend(0)
+
+def term_schedules(term_masks, course_ids):
+    '''conflict_free_schedules for courses of a term_slot_masks() result.'''
+    return conflict_free_schedules([{section: decode_section_masks(masks)
+                                     for section, masks in term_masks[course_id].items()}
+                                    for course_id in course_ids])
+
+def count_conflicts(term_masks):
+    '''Number of conflicting section pairs between different courses; mostly
+    useful for benchmarking.'''
+    sections = [(course_id, decode_section_masks(masks))
+                for course_id, course in term_masks.items() for masks in course.values()]
+    return sum(1 for (course_a, a), (course_b, b) in itertools.combinations(sections, 2)
+               if course_a != course_b and masks_conflict(a, b))
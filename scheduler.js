@@ -4,13 +4,43 @@ var globalCourses;
 var globalFavCourses;
 var globalTerm;
 var globalShowMoreIndex;
+// set by "Show All" until the search changes
+var globalShowAll = false;
+// how many results are shown before "Show All"
+var RESULTS_SHOWN = 100;
 var globalCourseAreas = {};
 
-fetch('/data/main.json').then(function(response){
-  return response.json();
+var globalManifest = null;
+// term -> its <term>_shards.json, for terms published in shards
+var globalShards = {};
+// term -> {shard name: true once loaded, false while loading}
+var globalLoadedShards = {};
+// term -> its <term>_search.json once loaded, null while loading
+var globalSearchIndex = {};
+// term -> version (see termVersion) of the data in globalCourseData
+var globalTermVersion = {};
+
+fetch('/data/manifest.json', {cache: 'no-cache'}).then(function(response) {
+  return response.ok ? response.json() : null;
+}, function(error) {
+  return null;
+}).then(function(manifest) {
+  globalManifest = manifest;
+  return fetchData('main.json');
 }).then(function(json) {
   globalTerm = json['selected'];
-  globalCourseData[globalTerm] = json['selected_data'];
+  if ('selected_data' in json) {
+    globalCourseData[globalTerm] = json['selected_data'];
+    globalTermVersion[globalTerm] = termVersion(globalTerm);
+    return json;
+  }
+  // the packed and sharded main files leave the selected term to its own
+  // files
+  return loadTerm(globalTerm).then(function(data) {
+    globalCourseData[globalTerm] = data;
+    return json;
+  });
+}).then(function(json) {
   createDropdownBlock("Course Term:", "course-terms", globalTerm);
   createDropdownBlock("Course Area:", "course-areas", "All");
   var terms = json['terms']; // TODO: implement all
@@ -27,19 +57,379 @@ fetch('/data/main.json').then(function(response){
   //getAllDepartments();
   addExtraAttributes();
   updateSearch();
+  setInterval(refreshEnrollment, ENROLLMENT_POLL_MS);
+  setInterval(refreshTerm, TERM_POLL_MS);
 })
 
+// Published files are listed in manifest.json along with their hashes;
+// where a file has a packed copy (see portal-scraper/packed.py) that is
+// fetched instead. The hash goes in the URL so a changed file is never
+// served from a stale cache.
+function dataUrl(name) {
+  var entry = globalManifest && globalManifest['files'][name];
+  return '/data/' + name + (entry ? '?v=' + entry['sha256'].slice(0, 16) : '');
+}
+
+function fetchData(name) {
+  var packedName = name.replace(/\.json$/, '.packed.json');
+  if (globalManifest && packedName in globalManifest['files']) {
+    return fetch(dataUrl(packedName)).then(function(response) {
+      return response.json();
+    }).then(unpackData);
+  }
+  return fetch(dataUrl(name)).then(function(response) {
+    return response.json();
+  });
+}
+
+// Fetches a term's data, or for a sharded term its list of shards, in
+// which case the data starts out empty and loadShards fills it in.
+function loadTerm(term) {
+  loadSearchIndex(term);
+  var version = termVersion(term);
+  var shardsName = term + '_shards.json';
+  if (globalManifest && shardsName in globalManifest['files']) {
+    return fetchData(shardsName).then(function(shards) {
+      globalShards[term] = shards;
+      globalLoadedShards[term] = {};
+      globalTermVersion[term] = version;
+      return {};
+    });
+  }
+  return fetchData(term + '.json').then(function(data) {
+    globalTermVersion[term] = version;
+    return data;
+  });
+}
+
+// Shards holding the courses (of those with the given ids) that could
+// pass the code and campus filters, in the order of the ids, each with how
+// many such courses it holds; the other filters need the data itself.
+function neededShards(term, ids, codeRe, campus) {
+  var counts = {};
+  var needed = [];
+  var courses = globalShards[term]['courses'];
+  ids.forEach(function(id) {
+    if (id.match(codeRe) && (!campus || campusName(id) === campus)) {
+      if (!(courses[id] in counts)) {
+        counts[courses[id]] = 0;
+        needed.push(courses[id]);
+      }
+      counts[courses[id]]++;
+    }
+  });
+  return needed.map(function(name) {
+    return [name, counts[name]];
+  });
+}
+
+// Of the needed shards, those to load to fill the results shown when
+// found courses have turned up in the shards loaded so far: an empty
+// search shouldn't load the whole term for its first RESULTS_SHOWN.
+function shardsToShow(term, needed, found, limit) {
+  var loaded = globalLoadedShards[term];
+  var names = [];
+  needed.forEach(function(shard) {
+    if (loaded[shard[0]] !== true && found < limit) {
+      names.push(shard[0]);
+      found += shard[1];
+    }
+  });
+  return names;
+}
+
+function loadSearchIndex(term) {
+  var name = term + '_search.json';
+  if (globalManifest && name in globalManifest['files'] && !(term in globalSearchIndex)) {
+    globalSearchIndex[term] = null;
+    fetchData(name).then(function(index) {
+      globalSearchIndex[term] = index;
+      if (term == globalTerm) {
+        updateSearch(true);
+      }
+    }, function(error) {
+      delete globalSearchIndex[term];
+    });
+  }
+}
+
+// Words as portal-scraper/searchindex.py splits them.
+function searchTokens(text) {
+  return text.normalize('NFKD').replace(/[\u0300-\u036f]/g, '').toLowerCase().match(/[a-z0-9]+/g) || [];
+}
+
+// Courses (by their number in the index) with a word in the field
+// containing word.
+function substringMatches(index, field, word) {
+  var tokens = index['fields'][field]['tokens'];
+  var postings = index['fields'][field]['postings'];
+  var matches = {};
+  for (var i = 0; i < tokens.length; i++) {
+    if (tokens[i].indexOf(word) !== -1) {
+      for (var j = 0; j < postings[i].length; j++) {
+        matches[postings[i][j]] = true;
+      }
+    }
+  }
+  return matches;
+}
+
+// Ids, in term order, of the courses where every word of each query is
+// part of a word of its field (queries maps field to text) and that are in
+// the course area if one is given: every course whose field contains the
+// query, and maybe some that don't. Returns null when the term's index
+// isn't loaded or there is nothing to look up.
+function searchIndex(term, queries, coursearea) {
+  var index = globalSearchIndex[term];
+  if (!index) {
+    return null;
+  }
+  var matches = null;
+  function narrow(found) {
+    if (matches === null) {
+      matches = found;
+      return;
+    }
+    for (var course in matches) {
+      if (!(course in found)) {
+        delete matches[course];
+      }
+    }
+  }
+  for (var field in queries) {
+    searchTokens(queries[field]).forEach(function(word) {
+      narrow(substringMatches(index, field, word));
+    });
+  }
+  if (coursearea && index['areas'] && coursearea in index['areas']) {
+    var inArea = {};
+    index['areas'][coursearea].forEach(function(course) { inArea[course] = true; });
+    narrow(inArea);
+  }
+  if (matches === null) {
+    return null;
+  }
+  return Object.keys(matches).map(Number).sort(function(a, b) { return a - b; }).map(function(course) {
+    return index['courses'][course];
+  });
+}
+
+function loadShards(term, names) {
+  var loaded = globalLoadedShards[term];
+  names.forEach(function(name) {
+    if (name in loaded) {
+      return;
+    }
+    loaded[name] = false;
+    fetchData(globalShards[term]['shards'][name]['file']).then(function(courses) {
+      loaded[name] = true;
+      for (var id in courses) {
+        globalCourseData[term][id] = courses[id];
+      }
+      addExtraAttributes(courses);
+      if (term == globalTerm) {
+        updateSearch(true);
+      }
+    }, function(error) {
+      delete loaded[name];
+    });
+  });
+}
+
+function unpackData(packed) {
+  var strings = packed['strings'];
+  var columns = packed['columns'];
+  var shapes = packed['shapes'].map(function(shape) {
+    return shape.map(function(i) { return strings[i]; });
+  });
+  var rows = shapes.map(function() { return 0; });
+  function decode(value) {
+    if (typeof value === 'number') {
+      return strings[value];
+    } else if (typeof value === 'string') {
+      return Number(value);
+    } else if (Array.isArray(value)) {
+      if (value[0] < 0) {
+        var list = new Array(value.length - 1);
+        for (var i = 1; i < value.length; i++) {
+          list[i - 1] = decode(value[i]);
+        }
+        return list;
+      }
+      var shape = value[0];
+      var row = rows[shape]++;
+      var keys = shapes[shape];
+      var object = {};
+      for (var i = 0; i < keys.length; i++) {
+        object[keys[i]] = decode(columns[shape][i][row]);
+      }
+      return object;
+    }
+    return value;
+  }
+  return decode(packed['data']);
+}
+
+// How often to pick up new enrollment figures for the current term.
+var ENROLLMENT_POLL_MS = 60 * 1000;
+
+function refreshEnrollment() {
+  var term = globalTerm;
+  if (!term || !globalCourseData[term]) {
+    return;
+  }
+  fetch('/data/' + term + '_enrollment.json', {cache: 'no-cache'}).then(function(response) {
+    if (!response.ok) {
+      throw response.status;
+    }
+    return response.json();
+  }).then(function(json) {
+    applyEnrollment(globalCourseData[term], json);
+  }, function(error) {
+    // no enrollment file for this term; keep what we have
+  });
+}
+
+// A term's published version, named as portal-scraper/delta.py names it.
+var DELTA_VERSION_LENGTH = 16;
+
+function termVersion(term) {
+  var entry = globalManifest && globalManifest['files'][term + '.json'];
+  return entry ? entry['sha256'].slice(0, DELTA_VERSION_LENGTH) : null;
+}
+
+// How often to look for a new version of the current term, and how many
+// deltas to follow to it before fetching the whole term instead.
+var TERM_POLL_MS = 5 * 60 * 1000;
+var MAX_DELTA_CHAIN = 12;
+
+function refreshTerm() {
+  var term = globalTerm;
+  if (!term || !globalCourseData[term] || !globalTermVersion[term]) {
+    return;
+  }
+  fetch('/data/manifest.json', {cache: 'no-cache'}).then(function(response) {
+    if (!response.ok) {
+      throw response.status;
+    }
+    return response.json();
+  }).then(function(manifest) {
+    globalManifest = manifest;
+    var latest = termVersion(term);
+    if (!latest || latest == globalTermVersion[term]) {
+      return;
+    }
+    // a sharded term's shards are loaded again as searches need them, the
+    // unchanged ones from the browser's cache; until then the courses
+    // loaded so far stay
+    var refreshed = term in globalShards ? loadTerm(term) : catchUp(term, latest, MAX_DELTA_CHAIN);
+    return refreshed.then(function() {
+      // the index may list courses that have gone, or miss new ones
+      delete globalSearchIndex[term];
+      loadSearchIndex(term);
+      addExtraAttributes(globalCourseData[term]);
+      if (term == globalTerm) {
+        updateSearch(true);
+      }
+    });
+  }).catch(function(error) {
+    // keep what we have; try again next time
+  });
+}
+
+// Brings globalCourseData[term] up to the latest version through the
+// chain of deltas from the version it has, or fetches the whole term if
+// the chain is longer than left or a delta is no longer published.
+function catchUp(term, latest, left) {
+  var version = globalTermVersion[term];
+  if (version == latest) {
+    return Promise.resolve();
+  }
+  var name = term + '_delta_' + version + '.json';
+  if (left == 0 || !(name in globalManifest['files'])) {
+    return fetchData(term + '.json').then(function(data) {
+      globalCourseData[term] = data;
+      globalTermVersion[term] = latest;
+    });
+  }
+  return fetchData(name).then(function(delta) {
+    applyDelta(globalCourseData[term], delta['courses'], 'sections', delta['order']);
+    globalTermVersion[term] = delta['to'];
+    return catchUp(term, latest, left - 1);
+  });
+}
+
+// Applies a delta's changes (see portal-scraper/delta.py) to records, in
+// place; nested is the key of each record's own records, if any, and order
+// the keys' new order, if it changed.
+function applyDelta(records, changes, nested, order) {
+  for (var key in changes) {
+    var change = changes[key];
+    if (change === null) {
+      delete records[key];
+    } else if ('full' in change) {
+      records[key] = change['full'];
+    } else {
+      var record = records[key] = records[key] || {};
+      var set = change['set'] || {};
+      for (var field in set) {
+        record[field] = set[field];
+      }
+      (change['unset'] || []).forEach(function(field) {
+        delete record[field];
+      });
+      if (nested && (nested in change || 'order' in change)) {
+        applyDelta(record[nested] = record[nested] || {}, change[nested] || {}, null, change['order']);
+      }
+    }
+  }
+  if (order) {
+    var items = {};
+    for (var key in records) {
+      items[key] = records[key];
+      delete records[key];
+    }
+    order.forEach(function(key) {
+      if (key in items) {
+        records[key] = items[key];
+        delete items[key];
+      }
+    });
+    for (var key in items) {
+      records[key] = items[key];
+    }
+  }
+}
+
+function applyEnrollment(courseData, enrollment) {
+  var fields = enrollment['fields'];
+  for (var id in enrollment['courses']) {
+    if (!(id in courseData)) {
+      continue;
+    }
+    var sections = enrollment['courses'][id];
+    for (var sectionId in sections) {
+      var section = courseData[id]['sections'][sectionId];
+      if (!section) {
+        continue;
+      }
+      for (var i = 0; i < fields.length; i++) {
+        if (sections[sectionId][i] !== null) {
+          section[fields[i]] = sections[sectionId][i];
+        }
+      }
+      section.full = !(section['capacity'] && section['currentEnrollment'] && (section['currentEnrollment'] < section['capacity']));
+    }
+  }
+}
+
 function fetchCourseAreas() {
   term = globalTerm;
   if(!(term in globalCourseAreas)) {
-    fetch('/data/'+term+'_infomap.json').then(function(response) {
-      return response.json();
-    }, function(error) {
-      globalCourseAreas[term] = {}
-    }).then(function(json){
+    fetchData(term+'_infomap.json').then(function(json){
       globalCourseAreas[term] = json;
       area = $("#course-areas_btn").attr('realVal');
-      if(area != "All") updateSearch();
+      if(area != "All") updateSearch(true);
     }, function(error) {
       globalCourseAreas[term] = {}
     })
@@ -68,46 +458,38 @@ function getAllDepartments() {
 
 
 
-function addExtraAttributes() {
-  for (var id in globalCourseData[globalTerm]) {
-    key = globalCourseData[globalTerm][id]
+//Currently, courses which are jointly taught (JT) will not show up no matter which college you select.
+function campusName(id) {
+  switch (id.slice(-2)) {
+    case 'HM':
+      return "Harvey Mudd";
+    case 'CG':
+      return "Claremont Graduate University";
+    case 'CM':
+      return "Claremont McKenna";
+    case 'SC':
+      return "Scripps";
+    case 'PO':
+      return "Pomona";
+    case 'PZ':
+      return "Pitzer";
+    case 'KS':
+      return "Keck Science";
+    case 'JM':
+      return "Joint Music";
+    case 'JP':
+      return "CMS PE";
+    default:
+      return "Other";
+  }
+}
+
+function addExtraAttributes(courses) {
+  courses = courses || globalCourseData[globalTerm];
+  for (var id in courses) {
+    key = courses[id]
     //Add the campus the course is on to its attributes
-    //Currently, courses which are jointly taught (JT) will not show up no matter which college you select.
-    var courseCode = id.slice(-2);
-    var college = "";
-    switch (courseCode) {
-      case 'HM':
-        college = "Harvey Mudd";
-        break;
-      case 'CG':
-        college = "Claremont Graduate University";
-        break;
-      case 'CM':
-        college = "Claremont McKenna";
-        break;
-      case 'SC':
-        college = "Scripps";
-        break;
-      case 'PO':
-        college = "Pomona";
-        break;
-      case 'PZ':
-        college = "Pitzer";
-        break;
-      case 'KS':
-        college = "Keck Science";
-        break;
-      case 'JM':
-        college = "Joint Music";
-        break;
-      case 'JP':
-        college = "CMS PE";
-        break;
-      default:
-        college = "Other";
-        break;
-    }
-    key.campus = college;
+    key.campus = campusName(id);
     // Add its filled status (whether or not there are empty seats left)
     // Currently, full is false if there is even 1 unfilled section
 
@@ -128,7 +510,12 @@ function addExtraAttributes() {
 
 
 
-function updateSearch() {
+// keepShown is set when more of the term's data has come in, rather than
+// the search changing, so that "Show All" stays in effect.
+function updateSearch(keepShown) {
+  if (!keepShown) {
+    globalShowAll = false;
+  }
   globalTerm = $("#course-terms_btn").attr('realVal');
   if (!globalTerm) {
     return;
@@ -140,9 +527,7 @@ function updateSearch() {
       fetchCourseAreas();
       globalCourseData[globalTerm] = null;
       term = globalTerm
-      fetch('/data/' + term + '.json').then(function(response){
-        return response.json();
-      }).then(function(json) {
+      loadTerm(term).then(function(json) {
         globalCourseData[term] = json
       }).then(updateSearch);
       return
@@ -173,10 +558,33 @@ function updateSearch() {
   var codeRe = implementRegex(useCodeRegex, code);
   var instructorRe = implementRegex(useInstructorRegex, instructor);
 
-  validCourses = []
-  for(var id in globalCourseData[globalTerm]) {
-    validCourses.push(globalCourseData[globalTerm][id])
+  // The term's search index narrows plain (not regex or wildcard) queries
+  // down to the courses that might match, which are then checked as
+  // before, and answers the area filter.
+  function indexable(useRegex, text) {
+    return useRegex || /[*?]/.test(text) ? '' : text;
   }
+  var indexArea = coursearea && coursearea != "All" ? coursearea : null;
+  var courseIds = searchIndex(globalTerm, {
+    'name': indexable(useTitleRegex, title),
+    'id': indexable(useCodeRegex, code),
+    'instructors': indexable(useInstructorRegex, instructor)}, indexArea);
+  if (courseIds !== null) {
+    var areas = globalSearchIndex[globalTerm]['areas'];
+    if (indexArea && areas && indexArea in areas) {
+      coursearea = "All";
+    }
+  } else if (globalTerm in globalShards) {
+    courseIds = Object.keys(globalShards[globalTerm]['courses']);
+  } else {
+    courseIds = Object.keys(globalCourseData[globalTerm]);
+  }
+  validCourses = []
+  courseIds.forEach(function(id) {
+    if (id in globalCourseData[globalTerm]) {
+      validCourses.push(globalCourseData[globalTerm][id]);
+    }
+  });
   validCourses = getCoursesFromAttributeRegex(validCourses, "name", titleRe);
   validCourses = getCoursesFromAttributeRegex(validCourses, "id", codeRe);
   validCourses = getInstructorRegex(validCourses, instructorRe);
@@ -193,6 +601,13 @@ function updateSearch() {
   if (coursearea != "All" && term in globalCourseAreas) {
     validCourses = getCoursesFromArea(validCourses, coursearea);
   }
+  if (globalTerm in globalShards) {
+    // search what has loaded so far; each shard that arrives runs the
+    // search again
+    var needed = neededShards(globalTerm, courseIds, codeRe, campus);
+    loadShards(globalTerm, shardsToShow(globalTerm, needed, validCourses.length,
+                                        globalShowAll ? Infinity : RESULTS_SHOWN));
+  }
 
 //   if (globalTerm != "") {
 //     validCourses = filterCoursesByCalendar(validCourses, "designator", globalTerm);
@@ -723,7 +1138,11 @@ function generateSchedules(courses) {
 
 
   // And remove conflicting schedules
-  return options.allowConflicts ? concatted : concatted.filter(function(timeSlots) {
+  return options.allowConflicts ? concatted : concatted.filter(function(timeSlots, i) {
+    var masksConflict = comboMasksConflict(combos[i]);
+    if (masksConflict !== null) {
+      return !masksConflict;
+    }
     // Loop over every six minute interval and make sure no two classes occupy it
     for (var day = 0; day < 5; day++) {
 
@@ -753,6 +1172,67 @@ function generateSchedules(courses) {
   });
 }
 
+// Whether two sections of a combination (one list of time slots per
+// course) conflict by their slot masks, or null if a section has none.
+function comboMasksConflict(combo) {
+  var sections = [];
+  for (var slots of combo) {
+    if (slots.length == 0) {
+      continue;
+    }
+    var masks = sectionSlotMasks(slots[0].sectionData);
+    if (!masks) {
+      return null;
+    }
+    sections.push({name: slots[0].course.name, masks: masks});
+  }
+  for (var i = 0; i < sections.length; i++) {
+    for (var j = i + 1; j < sections.length; j++) {
+      if (sections[i].name != sections[j].name && slotMasksConflict(sections[i].masks, sections[j].masks)) {
+        return true;
+      }
+    }
+  }
+  return false;
+}
+
+// section data -> its decoded "slots" (see portal-scraper/timeslots.py)
+var globalSlotMasks = new WeakMap();
+
+function sectionSlotMasks(sectionData) {
+  if (!sectionData || !sectionData['slots']) {
+    return null;
+  }
+  if (!globalSlotMasks.has(sectionData)) {
+    globalSlotMasks.set(sectionData, sectionData['slots'].map(function(group) {
+      var bytes = atob(group[2]);
+      var words = new Uint32Array(Math.ceil(bytes.length / 4));
+      for (var i = 0; i < bytes.length; i++) {
+        words[i >> 2] |= bytes.charCodeAt(i) << (24 - 8 * (i & 3));
+      }
+      return {start: group[0], end: group[1], words: words};
+    }));
+  }
+  return globalSlotMasks.get(sectionData);
+}
+
+function slotMasksConflict(masksA, masksB) {
+  for (var a of masksA) {
+    for (var b of masksB) {
+      // ISO dates compare as strings; a missing date is unbounded
+      if ((a.start && b.end && a.start > b.end) || (b.start && a.end && b.start > a.end)) {
+        continue;
+      }
+      for (var i = 0; i < a.words.length; i++) {
+        if (a.words[i] & b.words[i]) {
+          return true;
+        }
+      }
+    }
+  }
+  return false;
+}
+
 function sectionDatesOverlap(sectionData_a, sectionData_b) {
   a_start = new Date(sectionData_a['startDate'])
   a_end = new Date(sectionData_a['endDate'])
@@ -1365,7 +1845,7 @@ function formatSectionSchedule(section) {
 function repopulateChart() {
   $("#results-table").find("tbody").remove();
   $("#results-table").append($("<tbody>"));
-  for (var i = 0; i < globalCourseSearch.length && i < 100; i++) {
+  for (var i = 0; i < globalCourseSearch.length && (globalShowAll || i < RESULTS_SHOWN); i++) {
     showResult(i);
   }
   if(i < globalCourseSearch.length) {
@@ -1401,6 +1881,12 @@ function removeShowMore() {
 }
 
 function showMore() {
+  globalShowAll = true;
+  if (globalTerm in globalShards) {
+    // the rest of the results may be in shards not loaded yet
+    updateSearch(true);
+    return;
+  }
   removeButtonListeners();
   removeShowMore();
   for (var i = globalShowMoreIndex; i < globalCourseSearch.length; i++) {